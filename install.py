@@ -29,6 +29,9 @@ install_mime = True
 
 # Files to be installed, as (source file, destination directory)
 FILES = (('src/acbfdocument.py', 'share/acbfv/src'),
+         ('src/archive.py', 'share/acbfv/src'),
+         ('src/bookcache.py', 'share/acbfv/src'),
+         ('src/fontcache.py', 'share/acbfv/src'),
          ('src/acbfv.py', 'share/acbfv/src'),
          ('src/comicpage.py', 'share/acbfv/src'),
          ('src/constants.py', 'share/acbfv/src'),
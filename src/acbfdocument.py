@@ -19,7 +19,6 @@ https://github.com/ACBF-Advanced-Comic-Book-Format
 # -------------------------------------------------------------------------
 
 import os.path
-import shutil
 import lxml.etree as xml
 from lxml import objectify
 import base64
@@ -35,22 +34,43 @@ from xml.sax.saxutils import escape
 import io
 import urllib.request, urllib.parse, urllib.error
 import re
-import zipfile
 import uuid
-from matplotlib import font_manager
+import threading
+import mmap
+import json
+import hashlib
+from collections import OrderedDict
 
 try:
   from . import constants
+  from . import archive
+  from . import bookcache
+  from . import fontcache
 except:
   import constants
+  import archive
+  import bookcache
+  import fontcache
+
+# bump when structure of saved index changes
+INDEX_FORMAT = 5
+
+# document attributes stored in sidecar index
+INDEX_ATTRIBUTES = ('authors', 'genres', 'keywords', 'characters', 'databaseref', 'publisher', 'publish_date', 'city',
+                    'isbn', 'license', 'publish_date_value', 'doc_authors', 'creation_date', 'source', 'id', 'version',
+                    'history', 'book_title', 'annotation', 'genres_dict', 'languages', 'sequences', 'contents_table',
+                    'has_frames', 'bg_color', 'pages_total', 'binary_offsets', 'font_binaries', 'embedded_fonts', 'reference_texts',
+                    'font_colors')
   
 class ACBFDocument():
 
     def __init__(self, window,
-                       filename):
+                       filename,
+                       archive=None):
         self._window = window
-        self.coverpage = None
-        self.cover_thumb = None
+        self.archive = archive
+        self._coverpage = self._cover_thumb = None
+        self.coverpage_loaded = self.cover_thumb_loaded = False
         self.pages_total = 0
         self.bg_color = '#000000'
         self.valid = False
@@ -62,7 +82,17 @@ class ACBFDocument():
         self.contents_table = self.sequences = []
         self.book_title = self.annotation = self.genres_dict = {}
         self.has_frames = False
-        self.fonts_dir = os.path.join(self._window.tempdir, 'Fonts')
+        self.binary_index = {}
+        self.reference_texts = {}
+        self.binary_offsets = {}
+        self.font_binaries = []
+        self.embedded_fonts = {}
+        self.fonts_extracted = False
+        self.fonts_lock = threading.Lock()
+        self.zip_archives = {}
+        self.zip_archives_lock = threading.Lock()
+        self.decoded_binaries = OrderedDict()
+        self.decoded_binaries_lock = threading.Lock()
         self.font_styles = {'normal': '', 'emphasis': '', 'strong': '', 'code': '', 'commentary': '', 'sign': '', 'formal': '', 'heading': '', 'letter': '', 'audio': '', 'thought': ''}
         self.font_colors = {'inverted': '#ffffff', 'speech': '#000000', 'code': '#000000', 'commentary': '#000000', 'sign': '#000000', 'formal': '#000000', 'heading': '#000000', 'letter': '#000000', 'audio': '#000000', 'thought': '#000000'}
         for style in ['normal', 'emphasis', 'strong', 'code', 'commentary', 'sign', 'formal', 'heading', 'letter', 'audio', 'thought']:
@@ -71,38 +101,138 @@ class ACBFDocument():
         if self.filename:
           try:
             self.base_dir = os.path.dirname(filename)
-            self.tree = xml.parse(source = filename)
-            root = self.tree.getroot()
+            if self.is_indexed() and self.load_index():
+              self.valid = True
+              return
 
-            for elem in root.getiterator():
-              i = elem.tag.find('}')
-              if i >= 0:
-                elem.tag = elem.tag[i+1:]
+            self.binary_offsets = get_binary_offsets(filename)
+            self.font_binaries = []
+            self.tree = self.parse_document(filename)
+            root = self.tree.getroot()
             objectify.deannotate(root)
 
             self.bookinfo = self.tree.find("meta-data/book-info")
             self.publishinfo = self.tree.find("meta-data/publish-info")
             self.docinfo = self.tree.find("meta-data/document-info")
             self.references = self.tree.find("references")
+            self.load_references()
             self.bg_color = self.tree.find("body").get("bgcolor")
             if self.bg_color == None:
               self.bg_color = '#000000'
-            self.pages = self.tree.findall("body/" + "page")
+            self.cover = self.build_page(self.bookinfo.find("coverpage"))
+            self.pages = []
+            for page in self.tree.findall("body/" + "page"):
+              self.pages.append(self.build_page(page))
             self.pages_total = len(self.pages)
             self.binaries = self.tree.findall("data/" + "binary")
+            for binary in self.binaries:
+              # first of binaries sharing id is used
+              if binary.get("id") not in self.binary_index:
+                self.binary_index[binary.get("id")] = binary
+              if binary.get("content-type") == 'application/font-sfnt':
+                self.font_binaries.append(binary.get("id"))
             self.load_metadata()
             self.get_contents_table()
-            self.extract_fonts()
             self.stylesheet = self.tree.find("style")
             if self.stylesheet != None:
               self.load_stylesheet()
             #self.tree = None # keep memory usage low
             self.valid = True
+            if self.is_indexed():
+              self.save_index()
           except Exception as inst:
             print("Unable to open ACBF file: %s %s" % (filename, inst))
             self.valid = False
             return
 
+    def is_indexed(self):
+        """Returns True if document file is kept between sessions (standalone ACBF file or book in book cache),
+        books extracted into temporary directory are not indexed."""
+        tempdir = getattr(self._window, 'tempdir', None)
+        if tempdir is None:
+          return True
+        return not os.path.abspath(self.filename).startswith(os.path.join(os.path.abspath(tempdir), ''))
+
+    def load_index(self):
+        """Loads document structure from sidecar index (see save_index), returns False if index is missing or outdated."""
+        try:
+          stat = os.stat(self.filename)
+          f = open(bookcache.get_index_filename(self.filename), 'r', encoding='utf-8')
+          index = json.load(f, object_hook=decode_index_object)
+          f.close()
+          if (index['index_format'], index['viewer_version'], index['file_path'], index['file_size'], index['file_mtime']) != \
+             (INDEX_FORMAT, constants.VERSION, os.path.abspath(self.filename), stat.st_size, stat.st_mtime):
+            return False
+          # font styles hold font files found in system fonts
+          if index['fonts_signature'] != fontcache.get_fonts_signature():
+            return False
+          for attribute in INDEX_ATTRIBUTES:
+            setattr(self, attribute, index[attribute])
+          self.cover = Page(*index['cover'])
+          self.pages = []
+          for page in index['pages']:
+            self.pages.append(Page(*page))
+          if index['cover_thumb'] is not None:
+            self.cover_thumb = Image.open(io.BytesIO(base64.b64decode(index['cover_thumb'])))
+            self.cover_thumb.load()
+          self.font_styles.update(index['font_styles'])
+        except Exception:
+          return False
+        return True
+
+    def save_index(self):
+        """Saves parsed document structure into sidecar index file in cache directory,
+        so the document can be reopened without parsing it again."""
+        for binary in self.binaries:
+          if binary.get("id") not in self.binary_offsets:
+            # binary content is kept in tree only
+            return
+        try:
+          stat = os.stat(self.filename)
+          index = {'index_format': INDEX_FORMAT, 'viewer_version': constants.VERSION, 'file_path': os.path.abspath(self.filename),
+                   'file_size': stat.st_size, 'file_mtime': stat.st_mtime, 'fonts_signature': fontcache.get_fonts_signature()}
+          for attribute in INDEX_ATTRIBUTES:
+            index[attribute] = getattr(self, attribute)
+          index['cover'] = self.cover.get_values()
+          index['pages'] = []
+          for page in self.pages:
+            index['pages'].append(page.get_values())
+          index['font_styles'] = {}
+          for style, font in self.font_styles.items():
+            index['font_styles'][style] = str(font)
+          # thumbnail is stored only if it was decoded already, cover is not decoded just for the index
+          index['cover_thumb'] = None
+          if self.cover_thumb_loaded and self._cover_thumb is not None:
+            output = io.BytesIO()
+            self._cover_thumb.save(output, "PNG")
+            index['cover_thumb'] = base64.b64encode(output.getvalue()).decode('ascii')
+
+          index_filename = bookcache.get_index_filename(self.filename)
+          if not os.path.exists(os.path.dirname(index_filename)):
+            os.makedirs(os.path.dirname(index_filename), 0o700)
+          is_new = not os.path.exists(index_filename)
+          f = open(index_filename + '.part', 'w', encoding='utf-8')
+          json.dump(encode_index_value(index), f)
+          f.close()
+          os.replace(index_filename + '.part', index_filename)
+          # number of index files grows only when new one is written
+          if is_new:
+            bookcache.prune_index_files()
+        except Exception as inst:
+          print("Unable to save document index: %s" % inst)
+
+    def parse_document(self, filename):
+        """Parses ACBF file element by element, strips namespaces and drops payload of binaries
+        whose position in file is known (they are read from file when needed)."""
+        context = xml.iterparse(filename, events=('end',), huge_tree=True)
+        for event, elem in context:
+          i = elem.tag.find('}')
+          if i >= 0:
+            elem.tag = elem.tag[i+1:]
+          if elem.tag == 'binary' and elem.get("id") in self.binary_offsets:
+            elem.text = None
+        return xml.ElementTree(context.root)
+
     def load_metadata(self):
         self.authors = self.genres = self.keywords = self.characters = self.databaseref = ''
         self.publisher = self.publish_date = self.city = self.isbn = self.license = self.publish_date_value = ''
@@ -111,13 +241,6 @@ class ACBFDocument():
         self.annotation = {}
         self.genres_dict = {}
         
-        # get coverpage
-        image_id = self.bookinfo.find("coverpage/" + "image").get("href")
-        image_uri = ImageURI(image_id)
-        self.coverpage = self.load_image(image_uri)
-        self.cover_thumb = self.coverpage.copy()
-        self.cover_thumb.thumbnail((200, 200), Image.Resampling.NEAREST)
-
         # get authors
         for author in self.bookinfo.findall("author"):
           home_page = ''
@@ -252,21 +375,19 @@ class ACBFDocument():
 
         # has frames
         for page in self.pages:
-          for frame in page.findall("frame"):
+          if len(page.frames) > 0:
             self.has_frames = True
 
     def load_image(self, image_uri):
         #print(image_uri.file_type, image_uri.archive_path, image_uri.file_path, self._window.tempdir)
         try:
           if image_uri.file_type == "embedded":
-            for image in self.binaries:
-              if image.get("id") == image_uri.file_path:
-                decoded = base64.b64decode(image.text)
-                return Image.open(io.BytesIO(decoded))
+            decoded = self.read_binary(image_uri.file_path)
+            if decoded is not None:
+              return Image.open(io.BytesIO(decoded))
           elif image_uri.file_type == "zip":
-            z = zipfile.ZipFile(os.path.join(self.base_dir, image_uri.archive_path))
-            z.extract(image_uri.file_path, self._window.tempdir)
-            return Image.open(os.path.join(self._window.tempdir, image_uri.file_path))
+            zip_archive = self.get_zip_archive(os.path.join(self.base_dir, image_uri.archive_path))
+            return Image.open(zip_archive.open(image_uri.file_path))
           elif image_uri.file_type == "http":
               try:
                 http_image = Image.open(io.BytesIO(urllib.request.urlopen(image_uri.file_path).read()))
@@ -276,141 +397,246 @@ class ACBFDocument():
                 md.run()
                 md.destroy()
           else:
-            return Image.open(os.path.join(self.base_dir, image_uri.file_path))
+            image_path = os.path.join(self.base_dir, image_uri.file_path)
+            if self.archive is not None and not os.path.isfile(image_path):
+              # lazy archive mode, read image directly from archive member
+              member = self.archive.member_name(image_path)
+              if member is not None:
+                return Image.open(self.archive.open(member))
+            return Image.open(image_path)
 
         except Exception as inst:
           print("Unable to read image: %s" % inst)
           return None
 
+    def read_binary(self, binary_id):
+        """Returns decoded content of embedded binary, recently used ones are kept decoded."""
+        with self.decoded_binaries_lock:
+          if binary_id in self.decoded_binaries:
+            self.decoded_binaries.move_to_end(binary_id)
+            return self.decoded_binaries[binary_id]
+        decoded = self.decode_binary(binary_id)
+        if decoded is None:
+          return None
+        with self.decoded_binaries_lock:
+          self.decoded_binaries[binary_id] = decoded
+          while len(self.decoded_binaries) > constants.DECODED_BINARIES_CACHE_SIZE:
+            self.decoded_binaries.popitem(last=False)
+        return decoded
+
+    def get_zip_archive(self, archive_path):
+        """Returns archive referenced by zip: image URI, archives stay open until document is closed."""
+        archive_path = os.path.abspath(archive_path)
+        with self.zip_archives_lock:
+          if archive_path not in self.zip_archives:
+            self.zip_archives[archive_path] = archive.ZipArchive(archive_path, os.path.dirname(archive_path))
+          return self.zip_archives[archive_path]
+
+    def close_zip_archives(self):
+        with self.zip_archives_lock:
+          for zip_archive in self.zip_archives.values():
+            zip_archive.close()
+          self.zip_archives = {}
+
+    def read_binary_payload(self, binary_id):
+        """Returns base64 encoded content of embedded binary."""
+        if binary_id in self.binary_offsets:
+          start, end = self.binary_offsets[binary_id]
+          f = open(self.filename, 'rb')
+          f.seek(start)
+          data = f.read(end - start)
+          f.close()
+          return data
+        binary = self.binary_index.get(binary_id)
+        if binary is None:
+          return None
+        return binary.text.encode('ascii')
+
+    def decode_binary(self, binary_id):
+        payload = self.read_binary_payload(binary_id)
+        if payload is None:
+          return None
+        return base64.b64decode(payload)
+
+    @property
+    def coverpage(self):
+        """Cover image, decoded when it's first needed."""
+        if not self.coverpage_loaded:
+          self._coverpage = self.load_cover_image()
+          if self._coverpage is not None:
+            self._coverpage.load()
+          self.coverpage_loaded = True
+        return self._coverpage
+
+    @coverpage.setter
+    def coverpage(self, image):
+        self._coverpage = image
+        self.coverpage_loaded = True
+
+    @property
+    def cover_thumb(self):
+        """200x200 cover thumbnail, decoded at reduced resolution when it's first needed."""
+        if not self.cover_thumb_loaded:
+          if self.coverpage_loaded and self._coverpage is not None:
+            self._cover_thumb = self._coverpage.copy()
+          else:
+            self._cover_thumb = self.load_cover_image((200, 200))
+          if self._cover_thumb is not None:
+            self._cover_thumb.thumbnail((200, 200), Image.Resampling.NEAREST)
+          self.cover_thumb_loaded = True
+        return self._cover_thumb
+
+    @cover_thumb.setter
+    def cover_thumb(self, image):
+        self._cover_thumb = image
+        self.cover_thumb_loaded = True
+
+    def load_cover_image(self, size = None):
+        """Opens cover image, JPEG covers are decoded at the smallest scale still covering size (if set)."""
+        if not hasattr(self, 'cover'):
+          return None
+        image = self.load_image(ImageURI(self.cover.image_href))
+        if image is not None and size is not None and image.format == 'JPEG':
+          image.draft(image.mode, size)
+        return image
+
     def load_page_image(self, page_num = 1):
         if page_num == 1:
-          pilBackgroundImage = self.coverpage
+          if self.coverpage_loaded:
+            pilBackgroundImage = self.coverpage
+          else:
+            pilBackgroundImage = self.load_cover_image()
           page_bg_color = '#000000'
         else:
-          image_id = self.pages[page_num - 2].find("image").get("href")
-          page_bg_color = self.pages[page_num - 2].get("bgcolor")
+          page_bg_color = self.pages[page_num - 2].bg_color
           if page_bg_color == None:
             page_bg_color = self.bg_color
 
-          image_uri = ImageURI(image_id)
+          image_uri = ImageURI(self.pages[page_num - 2].image_href)
           pilBackgroundImage = self.load_image(image_uri)
 
         return pilBackgroundImage, page_bg_color
 
-    def load_page_frames(self, page_num = 1):
+    def get_page(self, page_num):
         if page_num == 1:
-          xml_frames = self.bookinfo.findall("coverpage/" + "frame")
-          if xml_frames == None:
-            return []
-        else:
-          xml_frames = self.pages[page_num - 2].findall("frame")
-        frames = []
-        coordinate_list = []
-        for frame in xml_frames:
-          for coordinate in frame.get("points").split(' '):
-            coordinate_tuple = (int(coordinate.split(',')[0]), int(coordinate.split(',')[1]))
-            coordinate_list.append(coordinate_tuple)
-          frame_tuple = (coordinate_list, frame.get("bgcolor"))
-          frames.append(frame_tuple)
-          coordinate_list = []
-        return frames
+          return self.cover
+        return self.pages[page_num - 2]
+
+    def load_page_frames(self, page_num = 1):
+        return self.get_page(page_num).frames
 
     def load_page_texts(self, page_num, language):
+        if page_num == 1:
+          return [], []
+        # copies, link rectangles found while drawing text layer are kept with the drawn layer only
+        text_areas, references = self.pages[page_num - 2].text_layers.get(language, ([], []))
+        return list(text_areas), list(references)
+
+    def build_page(self, page_element):
+        """Parses page (or coverpage) element into Page model."""
+        page = Page()
+        if page_element.find("image") is not None:
+          page.image_href = page_element.find("image").get("href")
+        page.bg_color = page_element.get("bgcolor")
+        if page_element.get("transition") != None:
+          page.transition = page_element.get("transition")
+        for frame in page_element.findall("frame"):
+          coordinate_list = parse_points(frame.get("points"))
+          page.frames.append((coordinate_list, frame.get("bgcolor")))
+          page.frame_spans.append(get_polygon_span(coordinate_list))
+        for title in page_element.findall("title"):
+          page.titles.append((title.get("lang"), title.text))
+        for text_layer in page_element.findall("text-layer"):
+          text_areas, references = self.load_text_layer(text_layer)
+          if text_layer.get("lang") in page.text_layers:
+            page.text_layers[text_layer.get("lang")][0].extend(text_areas)
+            page.text_layers[text_layer.get("lang")][1].extend(references)
+          else:
+            page.text_layers[text_layer.get("lang")] = (text_areas, references)
+        return page
+
+    def load_references(self):
+        """Builds reference id -> text dictionary used for footnotes on all pages."""
+        self.reference_texts = {}
+        if self.references is None:
+          return
+        for item in self.references.findall("reference"):
+          all_lines = ''
+          for line in item.findall("p"):
+            all_lines = all_lines + line.text + '\n'
+          if item.get("id") not in self.reference_texts:
+            self.reference_texts[item.get("id")] = all_lines[:-2]
+
+    def load_text_layer(self, text_layer):
         text_areas = []
         references = []
-        all_lines = ''
         text_rotation = 0
         area_type = 'speech'
         inverted = False
-        if page_num == 1:
-          return text_areas, references
-        for text_layer in self.pages[page_num - 2].findall("text-layer"):
-          if text_layer.get("bgcolor") != None:
-            bgcolor_layer = text_layer.get("bgcolor")
+        if text_layer.get("bgcolor") != None:
+          bgcolor_layer = text_layer.get("bgcolor")
+        else:
+          bgcolor_layer = '#ffffff'
+        for text_area in text_layer.findall("text-area"):
+          if text_area.get("bgcolor") != None:
+            bgcolor = text_area.get("bgcolor")
+          else:
+            bgcolor = bgcolor_layer
+          if text_area.get("text-rotation") != None:
+            text_rotation = int(text_area.get("text-rotation"))
+          else:
+            text_rotation = 0
+          if text_area.get("type") != None:
+            area_type = text_area.get("type")
           else:
-            bgcolor_layer = '#ffffff'
-          if text_layer.get("lang") == language:
-            for text_area in text_layer.findall("text-area"):
-              if text_area.get("bgcolor") != None:
-                bgcolor = text_area.get("bgcolor")
-              else:
-                bgcolor = bgcolor_layer
-              if text_area.get("text-rotation") != None:
-                text_rotation = int(text_area.get("text-rotation"))
-              else:
-                text_rotation = 0
-              if text_area.get("type") != None:
-                area_type = text_area.get("type")
-              else:
-                area_type = 'speech'
-              if text_area.get("inverted") == None:
-                inverted = False
-              elif text_area.get("inverted").upper() == 'TRUE':
-                inverted = True
-              else:
-                inverted = False
-              if text_area.get("transparent") == None:
-                transparent = False
-              elif text_area.get("transparent").upper() == 'TRUE':
-                transparent = True
-              else:
-                transparent = False
-              coordinate_list = []
-              area_text = ''
-              for coordinate in text_area.get("points").split(' '):
-                coordinate_tuple = (int(coordinate.split(',')[0]), int(coordinate.split(',')[1]))
-                coordinate_list.append(coordinate_tuple)
-              for paragraph in text_area.findall("p"):
-                area_text = area_text + re.sub(r'<p[^>]*>', "",xml.tostring(paragraph, encoding='unicode', with_tail=False)).replace('</p>', ' <BR>')
-                # references
-                for reference in paragraph.findall("a"):
-                  for item in self.references.findall("reference"):
-                    if item.get("id") == reference.get("href")[1:]:
-                      all_lines = ''
-                      for line in item.findall("p"):
-                        all_lines = all_lines + line.text + '\n'
-                      all_lines = all_lines[:-2]
-                      references.append((reference.get("href")[1:], all_lines))
-                for commentary in paragraph.findall("commentary"): 
-                  for reference in commentary.findall("a"):
-                    for item in self.references.findall("reference"):
-                      if item.get("id") == reference.get("href")[1:]:
-                        all_lines = ''
-                        for line in item.findall("p"):
-                          all_lines = all_lines + line.text + '\n'
-                        all_lines = all_lines[:-2]
-                        references.append((reference.get("href")[1:], all_lines))
-
-              area_text = area_text[:-5]
-              text_area_tuple = (coordinate_list, area_text, bgcolor, text_rotation, area_type, inverted, transparent)
-              text_areas.append(text_area_tuple)
-
-        #print(xml.tostring(text_areas[0][1][0], encoding='unicode', pretty_print=True))
+            area_type = 'speech'
+          if text_area.get("inverted") == None:
+            inverted = False
+          elif text_area.get("inverted").upper() == 'TRUE':
+            inverted = True
+          else:
+            inverted = False
+          if text_area.get("transparent") == None:
+            transparent = False
+          elif text_area.get("transparent").upper() == 'TRUE':
+            transparent = True
+          else:
+            transparent = False
+          coordinate_list = parse_points(text_area.get("points"))
+          paragraphs = []
+          for paragraph in text_area.findall("p"):
+            paragraphs.append(get_text_runs(paragraph))
+            # references
+            for reference in paragraph.findall("a") + paragraph.findall("commentary/" + "a"):
+              reference_id = reference.get("href")[1:]
+              if reference_id in self.reference_texts:
+                references.append((reference_id, self.reference_texts[reference_id]))
+
+          text_area_tuple = (coordinate_list, paragraphs, bgcolor, text_rotation, area_type, inverted, transparent)
+          text_areas.append(text_area_tuple)
 
         return text_areas, references
 
     def get_page_transition(self, page_num):
         if page_num == 1:
           return 'undefined'
-        elif self.pages[page_num - 2].get("transition") == None:
-          return 'undefined'
-        else:
-          return self.pages[page_num - 2].get("transition")
+        return self.pages[page_num - 2].transition
 
     def get_contents_table(self):
         self.contents_table = []
         for lang in self.languages:
           contents = []
           for idx, page in enumerate(self.pages, start = 2):
-            for title in page.findall("title"):
-              if ((title.get("lang") == lang[0]) or (title.get("lang") == None)):
-                contents.append((title.text, str(idx)))
+            for title_lang, title in page.titles:
+              if ((title_lang == lang[0]) or (title_lang == None)):
+                contents.append((title, str(idx)))
           self.contents_table.append(contents)
 
     def load_stylesheet(self):
         #print(self.stylesheet.text)
         #sheet = cssutils.parseString(self.stylesheet.text)
         font = ''
+        font_cache = fontcache.FontCache()
         
         for rule in self.stylesheet.text.replace('\n', ' ').split('}'):
           if rule.strip() != '':
@@ -463,13 +689,12 @@ class ACBFDocument():
               for font_family in font_families.split(','):
                 #check if font exists in acbf document
                 font_family_stripped = font_family.strip().strip('"')
-                if os.path.isfile(os.path.join(self.fonts_dir, font_family_stripped)):
-                  font = os.path.join(self.fonts_dir, font_family_stripped)
+                font = self.get_embedded_font(font_family_stripped)
+                if font != '':
                   break
                 #search in system fonts
-                prop = font_manager.FontProperties(family=font_family_stripped, style=font_style, weight=font_weight, stretch=font_stretch)
-                font = font_manager.findfont(prop, fontext='ttf', fallback_to_default=False)
-                if 'matplotlib' not in font:
+                font = font_cache.find_font(font_family_stripped, font_style, font_weight, font_stretch)
+                if font != '' and 'matplotlib' not in font:
                   break
 
             if selector in ('P', 'TEXT-AREA') and font != '':
@@ -494,23 +719,62 @@ class ACBFDocument():
               self.font_styles['audio'] = font
             elif selector in ('TEXT-AREA[TYPE=THOUGHT]', 'TEXT-AREA[TYPE="THOUGHT"]') and font != '':
               self.font_styles['thought'] = font
+        font_cache.save_cache()
 
         for style in ['emphasis', 'strong', 'code', 'commentary', 'sign', 'formal', 'heading', 'letter', 'audio', 'thought']:
           if self.font_styles[style] == '':
             self.font_styles[style] = self.font_styles['normal']
         #print(self.font_styles)
 
+    def get_embedded_font(self, font_name):
+        """Returns path of font shipped with the book (Fonts folder or font binary), '' if there's none.
+        Font binaries are stored in shared font store named by hash of their content, file is written
+        by extract_fonts when text layer is drawn."""
+        if os.path.isfile(os.path.join(self.base_dir, 'Fonts', font_name)):
+          return os.path.join(self.base_dir, 'Fonts', font_name)
+        if font_name not in self.font_binaries:
+          return ''
+        if font_name not in self.embedded_fonts:
+          payload = self.read_binary_payload(font_name)
+          font_hash = hashlib.sha1(b''.join(payload.split())).hexdigest()
+          self.embedded_fonts[font_name] = os.path.join(constants.CONFIG_DIR, 'Cache', 'Fonts', font_hash + os.path.splitext(font_name)[1])
+        return self.embedded_fonts[font_name]
+
     def extract_fonts(self):
-      if os.path.exists(os.path.join(self.base_dir, 'Fonts')) and not os.path.exists(self.fonts_dir):
-        shutil.copytree(os.path.join(self.base_dir, 'Fonts'), self.fonts_dir)
-      if not os.path.exists(self.fonts_dir):
-        os.makedirs(self.fonts_dir, 0o700)
-      for font in self.binaries:
-        if font.get("content-type") == 'application/font-sfnt':
-          decoded = base64.b64decode(font.text)
-          f = open(os.path.join(self.fonts_dir, font.get("id")), 'wb')
-          f.write(decoded)
-          f.close()
+        """Writes font binaries used by stylesheet into font store (unless some book already did)."""
+        with self.fonts_lock:
+          if self.fonts_extracted:
+            return
+          for font_name, font_path in self.embedded_fonts.items():
+            if os.path.isfile(font_path):
+              continue
+            if not os.path.exists(os.path.dirname(font_path)):
+              os.makedirs(os.path.dirname(font_path), 0o700)
+            f = open(font_path + '.part', 'wb')
+            f.write(self.decode_binary(font_name))
+            f.close()
+            os.replace(font_path + '.part', font_path)
+          self.fonts_extracted = True
+
+class Page():
+
+    """Page structure parsed once per document: image, frames with their bounding boxes,
+    text areas and references per language, transition and titles."""
+
+    __slots__ = ('image_href', 'bg_color', 'transition', 'frames', 'frame_spans', 'text_layers', 'titles')
+
+    def __init__(self, image_href='', bg_color=None, transition='undefined', frames=None, frame_spans=None, text_layers=None, titles=None):
+        self.image_href = image_href
+        self.bg_color = bg_color
+        self.transition = transition
+        self.frames = frames if frames is not None else []
+        self.frame_spans = frame_spans if frame_spans is not None else []
+        self.text_layers = text_layers if text_layers is not None else {}
+        self.titles = titles if titles is not None else []
+
+    def get_values(self):
+        """Returns slot values in order of __init__ arguments (used by document index)."""
+        return [getattr(self, slot) for slot in self.__slots__]
 
 class ImageURI():
 
@@ -541,6 +805,60 @@ class ImageURI():
             self.file_path = self.file_path.replace('\\', '/')
 
 
+def get_binary_offsets(filename):
+    """Returns {id: (start, end)} file offsets of base64 payload of <binary> elements."""
+    offsets = {}
+    try:
+      f = open(filename, 'rb')
+      try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      finally:
+        f.close()
+    except Exception:
+      return offsets
+    try:
+      for match in re.finditer(rb'<(?:[\w.-]+:)?binary\b([^>]*)>([^<&]*)</', data):
+        id_match = re.search(rb'\bid\s*=\s*["\']([^"\']*)["\']', match.group(1))
+        if id_match is not None and id_match.group(1).decode('utf-8', 'replace') not in offsets:
+          # first of binaries sharing id is used
+          offsets[id_match.group(1).decode('utf-8', 'replace')] = (match.start(2), match.end(2))
+      match = id_match = None
+    finally:
+      data.close()
+    return offsets
+
+def parse_points(points):
+    """returns list of (x, y) tuples from points attribute"""
+    coordinate_list = []
+    for coordinate in points.split(' '):
+      coordinate_list.append((int(coordinate.split(',')[0]), int(coordinate.split(',')[1])))
+    return coordinate_list
+
+def get_polygon_span(coordinate_list):
+    """returns x_min, y_min, x_max, y_max coordinates of a polygon"""
+    x_list = [coordinate[0] for coordinate in coordinate_list]
+    y_list = [coordinate[1] for coordinate in coordinate_list]
+    return (min(x_list), min(y_list), max(x_list), max(y_list))
+
+def get_text_runs(element, style=(), link=None):
+    """Splits text of paragraph into styled runs (text, style, small_font, link_id),
+    style being tuple of inline tags enclosing the text (innermost last)."""
+    runs = []
+    if element.text:
+      runs.append((element.text, style, is_small_font(style), link))
+    for child in element:
+      if isinstance(child.tag, str):
+        child_link = link
+        if child.tag == 'a' and child.get("href") is not None:
+          child_link = child.get("href")[1:]
+        runs.extend(get_text_runs(child, style + (child.tag.lower(),), child_link))
+      if child.tail:
+        runs.append((child.tail, style, is_small_font(style), link))
+    return runs
+
+def is_small_font(style):
+    return 'sup' in style or 'sub' in style or 'a' in style
+
 # function to retrieve text value from element without throwing exception
 def get_element_text(element_tree, element):
     try:
@@ -551,3 +869,18 @@ def get_element_text(element_tree, element):
       text_value = ''
     return text_value
 
+def encode_index_value(value):
+    """Returns value for JSON index, tuples are tagged so they are restored as tuples (see decode_index_object)."""
+    if isinstance(value, tuple):
+      return {'__tuple__': [encode_index_value(item) for item in value]}
+    if isinstance(value, list):
+      return [encode_index_value(item) for item in value]
+    if isinstance(value, dict):
+      return dict((key, encode_index_value(item)) for key, item in value.items())
+    return value
+
+def decode_index_object(value):
+    """JSON object hook restoring tuples tagged by encode_index_value."""
+    if len(value) == 1 and '__tuple__' in value:
+      return tuple(value['__tuple__'])
+    return value
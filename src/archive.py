@@ -0,0 +1,333 @@
+"""archive.py - read comic book archive members on demand.
+
+Copyright (C) 2011-2025 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os
+import io
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+
+try:
+  import rarfile
+except ImportError:
+  rarfile = None
+
+try:
+  import py7zr
+except ImportError:
+  py7zr = None
+
+def get_archive_type(filename):
+    """Returns 'ZIP', 'RAR' or '7Z' if the archive can be read in-process, None otherwise."""
+    if zipfile.is_zipfile(filename):
+      return 'ZIP'
+    if rarfile is not None and rarfile.is_rarfile(filename):
+      try:
+        # rarfile needs unrar/unar/bsdtar for decompression
+        rarfile.tool_setup()
+      except Exception:
+        return None
+      return 'RAR'
+    if py7zr is not None and py7zr.is_7zfile(filename):
+      return '7Z'
+    return None
+
+def open_archive(filename, root, archive_type=None):
+    """Returns archive reader for the file (or None if no in-process reader is available)."""
+    if archive_type is None:
+      archive_type = get_archive_type(filename)
+    if archive_type == 'ZIP':
+      return ZipArchive(filename, root)
+    elif archive_type == 'RAR':
+      return RarArchive(filename, root)
+    elif archive_type == '7Z':
+      return SevenZipArchive(filename, root)
+    return None
+
+class Archive():
+
+    """Keeps a comic book archive open so members can be read when they are needed
+    instead of extracting the whole archive up front. <root> is the directory
+    the archive is (virtually) extracted into."""
+
+    def __init__(self, filename, root):
+        self.filename = filename
+        self.root = root
+        self.members = {}
+
+    def namelist(self):
+        return list(self.members.keys())
+
+    def member_name(self, path):
+        """Returns archive member name for a path inside root directory (or None)."""
+        name = os.path.relpath(path, self.root).replace('\\', '/')
+        if name in self.members:
+          return name
+        return None
+
+    def open(self, name):
+        """Returns file object of member (archive readers implement open, read or both)."""
+        return io.BytesIO(self.read(name))
+
+    def read(self, name):
+        source = self.open(name)
+        data = source.read()
+        source.close()
+        return data
+
+    def is_solid(self):
+        """Returns True if members are decompressed from start of solid block (reading them one by one is slow)."""
+        return False
+
+    def member_size(self, name):
+        """Returns uncompressed size of archive member."""
+        return self.members[name].file_size
+
+    def extract(self, name, path):
+        """Extracts member into path. File is written under temporary name first,
+        so it never appears partially written to readers of the directory."""
+        target = get_member_path(path, name)
+        if not os.path.exists(os.path.dirname(target)):
+          os.makedirs(os.path.dirname(target), exist_ok=True)
+        source = self.open(name)
+        dest = open(target + '.part', 'wb')
+        shutil.copyfileobj(source, dest)
+        dest.close()
+        source.close()
+        os.replace(target + '.part', target)
+        return target
+
+    def extract_all(self, names, path):
+        """Extracts members into path, yields name of each member once it is in place."""
+        for name in names:
+          self.extract(name, path)
+          yield name
+
+    def extract_solid(self, names, path, extract_into):
+        """Extracts members in one pass by extract_into(directory) into temporary directory inside path,
+        then moves them into place and yields their names."""
+        if len(names) == 0:
+          return
+        tempdir = tempfile.mkdtemp(prefix='.extract-', dir=path)
+        try:
+          extract_into(tempdir)
+          for name in names:
+            target = get_member_path(path, name)
+            if not os.path.exists(os.path.dirname(target)):
+              os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(get_member_path(tempdir, name), target)
+            yield name
+        finally:
+          shutil.rmtree(tempdir, ignore_errors=True)
+
+    def close(self):
+        return
+
+class ZipArchive(Archive):
+
+    """Stored (uncompressed) members are served directly from memory mapped archive file,
+    only deflated members go through zipfile decompression."""
+
+    def __init__(self, filename, root):
+        Archive.__init__(self, filename, root)
+        self.zip = zipfile.ZipFile(filename)
+        for info in self.zip.infolist():
+          if not info.is_dir():
+            self.members[info.filename] = info
+        self.map = None
+        self.offsets = {}
+        try:
+          f = open(filename, 'rb')
+          self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+          f.close()
+        except Exception as inst:
+          print("Failed to map archive into memory: %s" % inst)
+
+    def get_view(self, name):
+        """Returns memoryview of stored member data (or None if member is compressed or encrypted)."""
+        info = self.members[name]
+        if self.map is None or info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+          return None
+        if name not in self.offsets:
+          # local file header: signature, ..., file name length and extra field length at offset 26
+          header = self.map[info.header_offset:info.header_offset + 30]
+          if len(header) < 30 or header[:4] != b'PK\x03\x04':
+            return None
+          name_length, extra_length = struct.unpack('<HH', header[26:30])
+          self.offsets[name] = info.header_offset + 30 + name_length + extra_length
+        offset = self.offsets[name]
+        if offset + info.file_size > len(self.map):
+          return None
+        return memoryview(self.map)[offset:offset + info.file_size]
+
+    def open(self, name):
+        view = self.get_view(name)
+        if view is not None:
+          return MemberView(view)
+        return self.zip.open(self.members[name])
+
+    def read(self, name):
+        view = self.get_view(name)
+        if view is not None:
+          data = view.tobytes()
+          view.release()
+          return data
+        return self.zip.read(self.members[name])
+
+    def close(self):
+        self.zip.close()
+        if self.map is not None:
+          try:
+            self.map.close()
+          except BufferError:
+            # member views still in use (e.g. not yet loaded images), mapping is released with them
+            None
+          self.map = None
+
+class MemberView(io.RawIOBase):
+
+    """Read-only seekable file object over memoryview of archive member data."""
+
+    def __init__(self, view):
+        io.RawIOBase.__init__(self)
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position = self.position + size
+        return size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+          size = len(self.view) - self.position
+        data = self.view[self.position:self.position + size].tobytes()
+        self.position = self.position + len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+          offset = self.position + offset
+        elif whence == io.SEEK_END:
+          offset = len(self.view) + offset
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def getbuffer(self):
+        return self.view
+
+    def close(self):
+        if not self.closed:
+          self.view.release()
+        io.RawIOBase.close(self)
+
+class RarArchive(Archive):
+
+    def __init__(self, filename, root):
+        Archive.__init__(self, filename, root)
+        self.rar = rarfile.RarFile(filename)
+        for info in self.rar.infolist():
+          if not info.is_dir():
+            self.members[info.filename.replace('\\', '/')] = info
+
+    def open(self, name):
+        return self.rar.open(self.members[name])
+
+    def read(self, name):
+        return self.rar.read(self.members[name])
+
+    def is_solid(self):
+        return self.rar.is_solid()
+
+    def extract_all(self, names, path):
+        if not self.is_solid():
+          return Archive.extract_all(self, names, path)
+        # one unrar run instead of decompressing solid archive from start for each member
+        return self.extract_solid(names, path, lambda tempdir: self.rar.extractall(tempdir, [self.members[name] for name in names]))
+
+    def close(self):
+        self.rar.close()
+
+class SevenZipArchive(Archive):
+
+    """7z member read on its own is decompressed from start of its solid block,
+    so whole archive is extracted in one pass (extract_all) and read is used for random access only."""
+
+    def __init__(self, filename, root):
+        Archive.__init__(self, filename, root)
+        self.lock = threading.Lock()
+        self.sevenzip = py7zr.SevenZipFile(filename, 'r')
+        for info in self.sevenzip.list():
+          if not info.is_directory:
+            self.members[info.filename.replace('\\', '/')] = info
+
+    def member_size(self, name):
+        return self.members[name].uncompressed
+
+    def is_solid(self):
+        try:
+          return self.sevenzip.archiveinfo().solid
+        except Exception:
+          return True
+
+    def extract_all(self, names, path):
+        def extract_into(tempdir):
+          with self.lock:
+            self.sevenzip.reset()
+            self.sevenzip.extract(path=tempdir, targets=[self.members[name].filename for name in names])
+        return self.extract_solid(names, path, extract_into)
+
+    def read(self, name):
+        member = self.members[name].filename
+        with self.lock:
+          self.sevenzip.reset()
+          if hasattr(self.sevenzip, 'read'):
+            return self.sevenzip.read(targets=[member])[member].read()
+          # newer py7zr versions can only extract to disk
+          tempdir = tempfile.mkdtemp()
+          try:
+            self.sevenzip.extract(path=tempdir, targets=[member])
+            f = open(os.path.join(tempdir, *name.split('/')), 'rb')
+            data = f.read()
+            f.close()
+            return data
+          finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    def close(self):
+        self.sevenzip.close()
+
+def get_member_path(path, name):
+    """Returns path of archive member extracted into path (parts leading outside of path are dropped)."""
+    return os.path.abspath(os.path.join(path, *[p for p in name.split('/') if p not in ('', '.', '..')]))
@@ -0,0 +1,188 @@
+"""bookcache.py - cache of extracted/converted comic books (CONFIG_DIR/Cache).
+
+Copyright (C) 2011-2025 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os
+import shutil
+import time
+import hashlib
+import lxml.etree as xml
+
+try:
+  from . import constants
+except Exception:
+  import constants
+
+class BookCache():
+
+  """Keeps extracted archive members and generated ACBF files between sessions.
+     Books are keyed by path, size, modification time and (optionally) a quick content hash.
+     Least recently used books are removed when cache grows over size limit (cache_size preference in MB)."""
+
+  def __init__(self, preferences, enabled=True):
+      self.cache_dir = os.path.join(constants.CONFIG_DIR, 'Cache')
+      self.index_file_path = os.path.join(self.cache_dir, 'cache.xml')
+      self.size_limit = int(preferences.get_value("cache_size")) * 1024 * 1024
+      self.use_content_hash = preferences.get_value("cache_content_hash") == "True"
+      self.enabled = enabled and self.size_limit > 0
+      if self.enabled:
+        if not os.path.exists(self.cache_dir):
+          os.makedirs(self.cache_dir, 0o700)
+        self.load_index()
+
+  def create_new_tree(self):
+      self.tree = xml.Element("cache")
+
+      version = xml.SubElement(self.tree, "version")
+      version.text = constants.VERSION
+
+  def load_index(self):
+      try:
+        self.tree = xml.parse(source = self.index_file_path).getroot()
+      except:
+        self.create_new_tree()
+        self.save_index()
+
+  def save_index(self):
+      # written under temporary name first, so index is never left half written
+      f = open(self.index_file_path + '.part', 'w')
+      f.write(xml.tostring(self.tree, encoding='unicode', pretty_print=True))
+      f.close()
+      os.replace(self.index_file_path + '.part', self.index_file_path)
+
+  def get_key(self, filename):
+      stat = os.stat(filename)
+      key = '%s|%d|%d' % (os.path.abspath(filename), stat.st_size, int(stat.st_mtime))
+      if self.use_content_hash:
+        key = key + '|' + get_content_hash(filename, stat.st_size)
+      return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  def get_book(self, filename):
+      key = self.get_key(filename)
+      for book in self.tree.findall("book"):
+        if book.get("key") == key and os.path.isdir(os.path.join(self.cache_dir, key)):
+          return book
+      return None
+
+  def get_book_dir(self, filename):
+      """Returns directory for the book and True if it was found in cache"""
+      book = self.get_book(filename)
+      if book is not None:
+        book.set("used", str(time.time()))
+        self.save_index()
+        return os.path.join(self.cache_dir, book.get("key")), True
+
+      # drop entries of older versions of the same file
+      for old_book in self.tree.findall("book"):
+        if old_book.get("path") == os.path.abspath(filename):
+          self.remove_book(old_book)
+
+      key = self.get_key(filename)
+      book_dir = os.path.join(self.cache_dir, key)
+      if os.path.exists(book_dir):
+        shutil.rmtree(book_dir)
+      os.makedirs(book_dir, 0o700)
+      xml.SubElement(self.tree, "book", key=key, path=os.path.abspath(filename), used=str(time.time()),
+                     acbf='', complete='False', bytes='0')
+      self.save_index()
+      return book_dir, False
+
+  def get_acbf_filename(self, filename):
+      book = self.get_book(filename)
+      if book is None or book.get("acbf") == '':
+        return None
+      acbf_filename = os.path.join(self.cache_dir, book.get("key"), book.get("acbf"))
+      if not os.path.isfile(acbf_filename):
+        return None
+      return acbf_filename
+
+  def is_complete(self, filename):
+      book = self.get_book(filename)
+      return book is not None and book.get("complete") == 'True'
+
+  def store_book(self, filename, acbf_filename, complete):
+      """Records the ACBF file of the book, its size on disk and evicts least recently used books if over limit"""
+      # index may have been changed by another instance since it was loaded
+      self.load_index()
+      book = self.get_book(filename)
+      if book is None:
+        return
+      book_dir = os.path.join(self.cache_dir, book.get("key"))
+      book.set("acbf", os.path.relpath(acbf_filename, book_dir))
+      book.set("complete", str(complete))
+      book.set("bytes", str(get_directory_size(book_dir)))
+      book.set("used", str(time.time()))
+      self.evict(book.get("key"))
+      self.save_index()
+
+  def evict(self, keep_key):
+      books = sorted(self.tree.findall("book"), key=lambda book: float(book.get("used")))
+      total_size = 0
+      for book in books:
+        total_size = total_size + int(book.get("bytes"))
+      for book in books:
+        if total_size <= self.size_limit:
+          break
+        if book.get("key") == keep_key:
+          continue
+        total_size = total_size - int(book.get("bytes"))
+        self.remove_book(book)
+
+  def remove_book(self, book):
+      book_dir = os.path.join(self.cache_dir, book.get("key"))
+      if os.path.exists(book_dir):
+        shutil.rmtree(book_dir, ignore_errors=True)
+      book.getparent().remove(book)
+
+def get_index_filename(filename):
+    """Returns path of sidecar index file (parsed ACBF document structure) for ACBF file."""
+    index_name = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest() + '.acbfidx'
+    return os.path.join(constants.CONFIG_DIR, 'Cache', 'Index', index_name)
+
+def prune_index_files():
+    """Removes least recently written index files over INDEX_FILES_LIMIT."""
+    index_dir = os.path.join(constants.CONFIG_DIR, 'Cache', 'Index')
+    index_files = []
+    for f in os.listdir(index_dir):
+      if f.endswith('.acbfidx'):
+        index_files.append(os.path.join(index_dir, f))
+    if len(index_files) <= constants.INDEX_FILES_LIMIT:
+      return
+    index_files.sort(key=os.path.getmtime)
+    for f in index_files[:len(index_files) - constants.INDEX_FILES_LIMIT]:
+      os.unlink(f)
+
+def get_content_hash(filename, file_size):
+    """Quick content hash from beginning and end of the file (end of ZIP file holds its central directory)"""
+    content_hash = hashlib.sha1()
+    f = open(filename, 'rb')
+    content_hash.update(f.read(65536))
+    if file_size > 65536:
+      f.seek(max(65536, file_size - 65536))
+      content_hash.update(f.read(65536))
+    f.close()
+    return content_hash.hexdigest()
+
+def get_directory_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+      for f in files:
+        size = size + os.path.getsize(os.path.join(root, f))
+    return size
@@ -24,15 +24,19 @@ from PIL import Image, ImageOps, ImageDraw, ImageFont, ImageEnhance, ImageChops
 if not hasattr(Image, 'Resampling'): # for older version of Pillow
   Image.Resampling = Image
 
-from xml.sax.saxutils import unescape
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk as gtk
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
+from gi.repository import GLib
 import math
-import io
-import re
+import bisect
+import numpy
+import threading
+import functools
+import concurrent.futures
+from collections import OrderedDict
 
 try:
   from . import acbfdocument
@@ -43,14 +47,26 @@ except Exception:
 
 class ComicPage():
     
-    def __init__(self, window):
+    def __init__(self, window, page_number = None, frame_number = None, language = None, zoom_level = None, drawable_size = None):
         self._window = window
+        # page shown in main window is used unless other page is set (pages rendered in background),
+        # background threads get language, zoom level and drawable size read in GTK thread too
+        self.page_number = page_number
+        self.frame_number = frame_number
+        self.language = language
+        self.zoom_level = zoom_level
+        self.drawable_size = drawable_size
         self.bg_color = '#000000'
         self.rotation = 0
-        self.PILBackgroundImage, self.bg_color = self._window.acbf_document.load_page_image(self._window.page_number)
+        self.PILBackgroundImage, self.bg_color = self._window.acbf_document.load_page_image(self.get_page_number())
+        self.image_size = (0, 0)
+        if self.PILBackgroundImage is not None:
+          self.image_size = self.PILBackgroundImage.size
         self.PILBackgroundImageProcessed = None
         self.text_areas = self.references = []
         self.updated = False
+        self.text_layer_shown = False
+        self.loaded_page = None
         self.frames_total = 0
         self.normal_font = self.emphasis_font = self.strong_font = self.code_font = self.commentary_font = self.sign_font = self.formal_font = self.heading_font = self.letter_font = self.audio_font = self.thought_font = constants.FONTS_LIST[0][1]
         for font in constants.FONTS_LIST:
@@ -102,20 +118,23 @@ class ComicPage():
         else:
           self.font_color_default = self._window.preferences.get_value("font_color_default")
           self.font_color_inverted = self._window.preferences.get_value("font_color_inverted")
-        if self._window.acbf_document.languages[self._window.toolbar.language.get_active()][1] == 'TRUE':
-          self.draw_text_layer()
         if self._window.acbf_document.valid:
-          self.frames = self._window.acbf_document.load_page_frames(self._window.page_number)
+          self.frames = self._window.acbf_document.load_page_frames(self.get_page_number())
           self.frames_total = len(self.frames)
 
     def update(self, *args):
-        self.PILBackgroundImage, self.bg_color = self._window.acbf_document.load_page_image(self._window.page_number)
+        self.PILBackgroundImage, self.bg_color = self._window.acbf_document.load_page_image(self.get_page_number())
         if self.bg_color is None:
           self.bg_color = self._window.acbf_document.bg_color
-        self.frames = self._window.acbf_document.load_page_frames(self._window.page_number)
+        self.frames = self._window.acbf_document.load_page_frames(self.get_page_number())
         self.frames_total = len(self.frames)
-        if self._window.acbf_document.valid and len(self._window.acbf_document.languages) > 0:
-          self.text_areas, self.references = self._window.acbf_document.load_page_texts(self._window.page_number, self._window.acbf_document.languages[self._window.toolbar.language.get_active()][0])
+        if self.PILBackgroundImage is not None:
+          self.image_size = self.PILBackgroundImage.size
+          draft_size = self.get_draft_size()
+          if draft_size is not None and self.PILBackgroundImage.format == 'JPEG':
+            self.PILBackgroundImage.draft(self.PILBackgroundImage.mode, draft_size)
+        self.load_texts()
+        self.loaded_page = (self._window.acbf_document, self.get_page_number())
         self.updated = False
         for font in constants.FONTS_LIST:
           if font[0] == self._window.preferences.get_value("normal_font"):
@@ -167,70 +186,160 @@ class ComicPage():
         else:
           self.font_color_default = self._window.preferences.get_value("font_color_default")
           self.font_color_inverted = self._window.preferences.get_value("font_color_inverted")
-        if self._window.acbf_document.languages[self._window.toolbar.language.get_active()][1] == 'TRUE':
-          self.draw_text_layer()
-        
+        if self.text_layer_shown:
+          # page rendered with the text layer before doesn't need it drawn again
+          zoom_level = self.get_zoom_level()
+          if zoom_level == 3 and self.frames_total == 0:
+            zoom_level = 1
+          rendered = self._window.render_cache.get(self.get_render_key(self.get_drawable_size(), zoom_level))
+          if rendered is None:
+            self.get_text_layer()
+          else:
+            self.references = list(rendered[2])
+
+    def load_texts(self):
+        """Loads text-areas of the page in active language, page image is kept (language switch)."""
+        self.text_layer_shown = False
+        if self._window.acbf_document.valid and len(self._window.acbf_document.languages) > 0:
+          language = self._window.acbf_document.languages[self.get_language()]
+          self.text_areas, self.references = self._window.acbf_document.load_page_texts(self.get_page_number(), language[0])
+          self.text_layer_shown = language[1] == 'TRUE'
+
+    def is_loaded(self):
+        """Returns True if image of the page shown in main window is loaded already."""
+        return self.loaded_page == (self._window.acbf_document, self.get_page_number())
+
+    def get_page_number(self):
+        if self.page_number is None:
+          return self._window.page_number
+        return self.page_number
+
+    def get_frame_number(self):
+        if self.frame_number is None:
+          return self._window.frame_number
+        return self.frame_number
+
+    def get_language(self):
+        """Returns index of active text layer language."""
+        if self.language is None:
+          return self._window.toolbar.language.get_active()
+        return self.language
+
+    def get_zoom_level(self):
+        if self.zoom_level is None:
+          return self._window.zoom_level
+        return self.zoom_level
+
+    def get_drawable_size(self):
+        if self.drawable_size is None:
+          return self._window.drawable_size
+        return self.drawable_size
+
+    def get_frame_color(self, zoom_level):
+        if zoom_level == 3 and self.frames_total > 0:
+          frame_color = self.frames[self.get_frame_number() - 1][1]
+          if frame_color != None:
+            return frame_color
+        return self.bg_color
+
+    def get_render_key(self, size, zoom_level):
+        """Returns all parameters rendered page depends on (see get_PixBufImage)."""
+        window = self._window
+        enhancements = []
+        for value, toggle in ((window.image_sharpness_value, window.sharpness_button_toggle),
+                              (window.image_saturation_value, window.saturation_button_toggle),
+                              (window.image_brightness_value, window.brightness_button_toggle),
+                              (window.image_contrast_value, window.contrast_button_toggle)):
+          if int(value * 10) != 0 and toggle == True:
+            enhancements.append(value)
+          else:
+            enhancements.append(0)
+        return (self.get_page_number(), zoom_level, tuple(size), self.rotation, tuple(enhancements),
+                self.get_language(), self.get_frame_color(zoom_level))
+
+    def get_draft_size(self):
+        """Returns size the page image may be decoded at (JPEG decoder scales by 1/2, 1/4 or 1/8),
+        None if full resolution is needed (fit width, frame zoom, text layer drawn into the image)."""
+        zoom_level = self.get_zoom_level()
+        if not (zoom_level == 1 or (zoom_level == 3 and self.frames_total == 0)):
+          return None
+        if (self._window.acbf_document.valid and len(self._window.acbf_document.languages) > 0 and
+            self._window.acbf_document.languages[self.get_language()][1] == 'TRUE'):
+          return None
+        width, height = self.image_size
+        drawable_width, drawable_height = self.get_drawable_size()
+        # page may be (auto)rotated, so it has to fit the window both ways
+        scale = max(min(drawable_width/width, drawable_height/height), min(drawable_width/height, drawable_height/width))
+        if scale >= 1:
+          return None
+        return (int(width*scale) + 1, int(height*scale) + 1)
+
+    def ensure_resolution(self):
+        """Reloads page image if it was decoded at reduced size and current view needs more detail."""
+        if self.PILBackgroundImage is None or self.PILBackgroundImage.size == self.image_size:
+          return
+        draft_size = self.get_draft_size()
+        if draft_size is not None and self.PILBackgroundImage.size[0] >= draft_size[0] and self.PILBackgroundImage.size[1] >= draft_size[1]:
+          return
+        self.update()
 
     def load_font(self, font, height):
         if font == 'normal':
           if self.normal_font != '':
-            return ImageFont.truetype(self.normal_font, height)
+            return get_font(self.normal_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'emphasis':
           if self.emphasis_font != '':
-            return ImageFont.truetype(self.emphasis_font, height)
+            return get_font(self.emphasis_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'strong':
           if self.strong_font != '':
-            return ImageFont.truetype(self.strong_font, height)
+            return get_font(self.strong_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'code':
           if self.code_font != '':
-            return ImageFont.truetype(self.code_font, height)
+            return get_font(self.code_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'commentary':
           if self.commentary_font != '':
-            return ImageFont.truetype(self.commentary_font, height)
+            return get_font(self.commentary_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'sign':
           if self.sign_font != '':
-            return ImageFont.truetype(self.sign_font, height)
+            return get_font(self.sign_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'formal':
           if self.formal_font != '':
-            return ImageFont.truetype(self.formal_font, height)
+            return get_font(self.formal_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'heading':
           if self.heading_font != '':
-            return ImageFont.truetype(self.heading_font, height)
+            return get_font(self.heading_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'letter':
           if self.letter_font != '':
-            return ImageFont.truetype(self.letter_font, height)
+            return get_font(self.letter_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'audio':
           if self.audio_font != '':
-            return ImageFont.truetype(self.audio_font, height)
+            return get_font(self.audio_font, height)
           else:
             return ImageFont.load_default()
         elif font == 'thought':
           if self.thought_font != '':
-            return ImageFont.truetype(self.thought_font, height)
+            return get_font(self.thought_font, height)
           else:
             return ImageFont.load_default()
 
-    def remove_xml_tags(self, in_string):
-        return unescape(re.sub("<[^>]*>", '', in_string))
-
     def median(self, lst):
         lst = sorted(lst)
         if len(lst) < 1:
@@ -240,11 +349,175 @@ class ComicPage():
         else:
           return int(round(float(sum(lst[int(len(lst)/2)-1:int(len(lst)/2)+1]))/2.0, 0))
 
+    def get_run_fonts(self, runs, base_style, character_height):
+        """Returns list of fonts text runs are drawn with."""
+        fonts = []
+        loaded_fonts = {}
+        for run in runs:
+          key = (get_run_style(run, base_style), run[2])
+          if key not in loaded_fonts:
+            if run[2]:
+              loaded_fonts[key] = self.load_font(key[0], int(character_height/2))
+            else:
+              loaded_fonts[key] = self.load_font(key[0], character_height)
+          fonts.append(loaded_fonts[key])
+        return fonts
+
+    def get_measure_fonts(self, runs, base_style, character_height):
+        """Returns list of fonts text runs are measured with when text is broken into lines.
+        Sup, sub and link runs of plain speech text are measured with full size font, so lines break as they always did."""
+        fonts = self.get_run_fonts(runs, base_style, character_height)
+        if base_style == 'normal':
+          for idx, run in enumerate(runs):
+            if run[2] and get_run_style(run, base_style) == 'normal':
+              fonts[idx] = self.load_font('normal', character_height)
+        return fonts
+
+    def measure_word(self, draw, word, runs, fonts, font_height):
+        """Returns length of word and height of its last piece (font_height if word is empty).
+        Text following sup, sub or link run within the word is measured with font of that run, so lines break as they always did."""
+        word_length = 0
+        previous_run = None
+        for run_index, text in word[0]:
+          if previous_run is not None and runs[previous_run][2]:
+            font = fonts[previous_run]
+          else:
+            font = fonts[run_index]
+          text_length, font_height = self._window.text_measures.measure(draw, text, font)
+          word_length = word_length + text_length
+          previous_run = run_index
+        return word_length, font_height
+
+    def layout_text(self, draw, text_area, words, runs, spans, polygon_boundaries, character_height):
+        """Breaks words of text-area into lines for given font size.
+        Returns whether the text fits into text-area and list of lines (first_word_start, line_words, last_word_end)."""
+        is_commentary = text_area[4].upper() == 'COMMENTARY' or has_style(runs, 'commentary')
+        is_formal = text_area[4].upper() == 'FORMAL'
+        fonts = self.get_measure_fonts(runs, get_base_style(text_area[4].upper(), is_commentary), character_height)
+
+        # calculate text drawing start
+        polygon_x_min = polygon_boundaries[0]
+        polygon_y_min = polygon_boundaries[1]
+        polygon_x_max = polygon_boundaries[2]
+        polygon_y_max = polygon_boundaries[3]
+
+        text_drawing_start = (polygon_x_min + 2, polygon_y_min + 2)
+
+        font_height = 0
+        text_fits = True
+        space_between_lines = character_height + character_height * 0.3
+
+        drawing_word = 0
+        lines = [] # (first_word_start, line_words, last_word_end)
+        current_line = []
+        first_word_start = text_drawing_start
+        last_word_end = first_word_start
+
+        #draw line
+        while drawing_word < len(words):
+          #place first word in line
+          word_length, font_height = self.measure_word(draw, words[drawing_word], runs, fonts, font_height)
+          text_size = (word_length, font_height + 1)
+
+          place = spans.find_place(first_word_start[0], first_word_start[1], text_size[0], text_size[1], polygon_x_max, polygon_y_max)
+          if place is None:
+            first_word_start = text_drawing_start
+            text_fits = False
+          else:
+            first_word_start = (place[0] + 2, place[1])
+
+          current_line.append(words[drawing_word])
+          current_pointer = (first_word_start[0] + text_size[0], first_word_start[1])
+          drawing_word = drawing_word + 1
+
+          #place other words in line that fit
+          other_word_fits = True
+          while other_word_fits and drawing_word < len(words):
+            # new paragraph starts on new line
+            if words[drawing_word][1]:
+              other_word_fits = False
+
+            word_length, font_height = self.measure_word(draw, words[drawing_word], runs, fonts, font_height)
+            text_size = (word_length, font_height + 1)
+            upper_right_corner_fits = spans.contains(current_pointer[0] + text_size[0], current_pointer[1])
+            lower_right_corner_fits = spans.contains(current_pointer[0] + text_size[0], current_pointer[1] + text_size[1])
+
+            if other_word_fits and upper_right_corner_fits and lower_right_corner_fits:
+              diff_ratio = (polygon_y_max - (current_pointer[1] + text_size[1])) / float(text_size[1])
+              if drawing_word == len(words) - 1 and diff_ratio > 1.45 and not is_formal and not is_commentary:
+                other_word_fits = False
+                last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
+                lines.append((first_word_start, current_line, last_word_end))
+                current_line = []
+                first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
+              else:
+                current_line.append(words[drawing_word])
+                #draw.rectangle((current_pointer[0], current_pointer[1], current_pointer[0] + text_size[0], current_pointer[1] + text_size[1]), outline='#ff0000')
+                current_pointer = (current_pointer[0] + text_size[0], current_pointer[1])
+                drawing_word = drawing_word + 1
+            else:
+              other_word_fits = False
+              last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
+              lines.append((first_word_start, current_line, last_word_end))
+              current_line = []
+              first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
+
+        last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
+        lines.append((first_word_start, current_line, last_word_end))
+
+        return text_fits, lines
+
+    def fit_text(self, draw, text_area, words, runs, spans, polygon_boundaries, character_height):
+        """Finds largest font size (below character_height) the text fits into text-area with
+        and returns it with its lines. Sizes are tried downwards with growing step, then bisected
+        between the last size that didn't fit and the first one that did."""
+        layouts = {}
+        def fits(height):
+          if height not in layouts:
+            layouts[height] = self.layout_text(draw, text_area, words, runs, spans, polygon_boundaries, height)
+          return height < 1 or layouts[height][0]
+
+        too_big = character_height
+        height = character_height - 1
+        step = 1
+        while not fits(height):
+          too_big = height
+          height = max(height - step, 0)
+          step = step * 2
+        while too_big - height > 1:
+          middle = (too_big + height) // 2
+          if fits(middle):
+            height = middle
+          else:
+            too_big = middle
+        fits(height)
+        return height, layouts[height][1]
+
+    def get_text_layer(self):
+        """Returns text layer of the page in active language and its position on page image.
+        Layer is drawn once and kept in RenderCache together with link rectangles found while drawing it."""
+        key = ('text-layer', self.get_page_number(), self.get_language(), self.PILBackgroundImage.size)
+        text_layer = self._window.render_cache.get(key)
+        if text_layer is None:
+          # fonts returned by get_font are shared by all threads, FreeType faces can't be used concurrently
+          with fonts_lock:
+            overlay, position = self.draw_text_layer()
+          size = 0
+          if overlay is not None:
+            size = overlay.size[0]*overlay.size[1]*4
+          text_layer = (overlay, position, list(self.references))
+          self._window.render_cache.put(key, text_layer, size)
+        else:
+          self.references = list(text_layer[2])
+        return text_layer[0], text_layer[1]
+
     def draw_text_layer(self, *args):
+        """Draws text-areas over copy of page image, returns RGBA image of changed pixels and its position (None if there are none)."""
+        self._window.acbf_document.extract_fonts()
         text_areas_draw = []
-        if self.PILBackgroundImage.mode != 'RGB':
-          self.PILBackgroundImage = self.PILBackgroundImage.convert('RGB')
-        image_draw = ImageDraw.Draw(self.PILBackgroundImage)
+        text_measures = self._window.text_measures
+        text_image = self.PILBackgroundImage.convert('RGB')
+        image_draw = ImageDraw.Draw(text_image)
         for text_area in self.text_areas:
           polygon = []
 
@@ -285,379 +558,33 @@ class ComicPage():
           
           # calculate some default values
           polygon_area = area(polygon)
-          text = text_area[1]
-          if '<COMMENTARY>' in text.upper() or text_area[4].upper() == 'COMMENTARY':
-            is_commentary = True
-          else:
-            is_commentary = False
-          
-          if text_area[4].upper() == 'SIGN':
-            is_sign = True
-          else:
-            is_sign = False
-
-          if text_area[4].upper() == 'FORMAL':
-            is_formal = True
-          else:
-            is_formal = False
-
-          if text_area[4].upper() == 'HEADING':
-            is_heading = True
-          else:
-            is_heading = False
-
-          if text_area[4].upper() == 'LETTER':
-            is_letter = True
-          else:
-            is_letter = False
-
-          if text_area[4].upper() == 'AUDIO':
-            is_audio = True
-          else:
-            is_audio = False
-
-          if text_area[4].upper() == 'THOUGHT':
-            is_thought = True
-          else:
-            is_thought = False
-
-          if text_area[4].upper() == 'CODE':
-            is_code = True
-          else:
-            is_code = False
-          
-          is_emphasis = is_strong = False
-          words = text.replace('a href', 'a_href').replace(' ', ' ˇ').split('ˇ')
-          words_upper = text.replace(' ', 'ˇ').upper().split('ˇ')
-          area_per_character = polygon_area/len(self.remove_xml_tags(text))
+          runs, words = get_words(text_area[1])
+          area_per_character = polygon_area/len(get_line_text(words))
           character_height = int(math.sqrt(area_per_character/2)*2) - 3
 
-          # calculate text drawing start
-          polygon_x_min = polygon_boundaries[0]
-          polygon_y_min = polygon_boundaries[1]
-          polygon_x_max = polygon_boundaries[2]
-          polygon_y_max = polygon_boundaries[3]
-
-          text_drawing_start_fits = False
-          text_drawing_start = (polygon_x_min + 2, polygon_y_min + 2)
-
           #draw text
-          text_fits = False
-
-          while not text_fits:
-              text_fits = True
-              character_height = character_height - 1
-              space_between_lines = character_height + character_height * 0.3
-              
-              font = self.load_font('normal', character_height)
-              n_font = self.load_font('normal', character_height)
-              e_font = self.load_font('emphasis', character_height)
-              s_font = self.load_font('strong', character_height)
-              c_font = self.load_font('code', character_height)
-              co_font = self.load_font('commentary', character_height)
-              si_font = self.load_font('sign', character_height)
-              fo_font = self.load_font('formal', character_height)
-              he_font = self.load_font('heading', character_height)
-              le_font = self.load_font('letter', character_height)
-              au_font = self.load_font('audio', character_height)
-              th_font = self.load_font('thought', character_height)
-              n_font_small = self.load_font('normal', int(character_height/2))
-              e_font_small = self.load_font('emphasis', int(character_height/2))
-              s_font_small = self.load_font('strong', int(character_height/2))
-              c_font_small = self.load_font('code', int(character_height/2))
-              co_font_small = self.load_font('commentary', int(character_height/2))
-              si_font_small = self.load_font('sign', int(character_height/2))
-              fo_font_small = self.load_font('formal', int(character_height/2))
-              he_font_small = self.load_font('heading', int(character_height/2))
-              le_font_small = self.load_font('letter', int(character_height/2))
-              au_font_small = self.load_font('audio', int(character_height/2))
-              th_font_small = self.load_font('thought', int(character_height/2))
-
-              use_small_font = False
-
-              drawing_word = 0
-              drawing_line = 0
-              lines = [] # (first_word_start, line_text, last_word_end)
-              current_line = ''
-              first_word_start = text_drawing_start
-              last_word_end = first_word_start
-
-              #draw line
-              while drawing_word < len(words):
-                #place first word in line
-                first_word_fits = False
-                tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                chunk_size = 0
-
-                for chunk in tag_split:
-                  chunk_upper = chunk.upper()
-                  if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                    use_small_font = True
-                  elif '<EMPHASIS>' in chunk_upper:
-                    is_emphasis = True
-                  elif '<STRONG>' in chunk_upper:
-                    is_strong = True
-                  elif '<CODE>' in chunk_upper or text_area[4].upper() == 'CODE':
-                    is_code = True
-
-                  if is_commentary:
-                    if use_small_font:
-                      font = co_font_small
-                    else:
-                      font = co_font
-
-                  if is_sign:
-                    if use_small_font:
-                      font = si_font_small
-                    else:
-                      font = si_font
-
-                  if is_formal:
-                    if use_small_font:
-                      font = fo_font_small
-                    else:
-                      font = fo_font
-
-                  if is_heading:
-                    if use_small_font:
-                      font = he_font_small
-                    else:
-                      font = he_font
-
-                  if is_letter:
-                    if use_small_font:
-                      font = le_font_small
-                    else:
-                      font = le_font
-
-                  if is_audio:
-                    if use_small_font:
-                      font = au_font_small
-                    else:
-                      font = au_font
-
-                  if is_thought:
-                    if use_small_font:
-                      font = th_font_small
-                    else:
-                      font = th_font
-
-                  if is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if is_emphasis:
-                    if use_small_font:
-                      font = e_font_small
-                    else:
-                      font = e_font
-                  elif is_strong:
-                    if use_small_font:
-                      font = s_font_small
-                    else:
-                      font = s_font
-                  elif is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                    use_small_font = False
-
-                  if '</EMPHASIS>' in chunk_upper:
-                    is_emphasis = False
-                  elif '</STRONG>' in chunk_upper:
-                    is_strong = False
-                  elif '</CODE>' in chunk_upper:
-                    is_code = False
-
-                  current_chunk = self.remove_xml_tags(chunk)
-                  if current_chunk != '':
-                    chunk_size = chunk_size + draw.textlength(current_chunk, font=font)
-                    font_box = font.getbbox(current_chunk)
-                    font_height = font_box[3] - font_box[1]
-
-                text_size = (chunk_size, font_height + 1)
-                
-                while not first_word_fits:
-                  # check if text fits
-                  upper_left_corner_fits = point_inside_polygon(first_word_start[0], first_word_start[1], polygon)
-                  upper_right_corner_fits = point_inside_polygon(first_word_start[0] + text_size[0], first_word_start[1], polygon)
-                  lower_left_corner_fits = point_inside_polygon(first_word_start[0], first_word_start[1] + text_size[1], polygon)
-                  lower_right_corner_fits = point_inside_polygon(first_word_start[0] + text_size[0], first_word_start[1] + text_size[1], polygon)
-
-                  if upper_left_corner_fits and upper_right_corner_fits and lower_left_corner_fits and lower_right_corner_fits:
-                    first_word_fits = True
-                    first_word_start = (first_word_start[0] + 2, first_word_start[1])
-                  elif first_word_start[1] + text_size[1] > polygon_y_max:
-                    first_word_fits = True
-                    first_word_start = text_drawing_start
-                    text_fits = False
-                  elif first_word_start[0] + text_size[0] > polygon_x_max: # move down
-                    first_word_start = (text_drawing_start[0], first_word_start[1] + 2)
-                  else: # move right
-                    first_word_start = (first_word_start[0] + 2, first_word_start[1])
-
-                current_line = current_line + words[drawing_word]
-                current_pointer = (first_word_start[0] + text_size[0], first_word_start[1])
-                drawing_word = drawing_word + 1
+          spans = PolygonSpans(polygon)
+          character_height, lines = self.fit_text(draw, text_area, words, runs, spans, polygon_boundaries, character_height)
 
-                #place other words in line that fit
-                other_word_fits = True
-                while other_word_fits and drawing_word < len(words):
-                  tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                  chunk_size = 0
-
-                  for chunk in tag_split:
-                    chunk_upper = chunk.upper()
-                    if '<BR>' in chunk_upper:
-                      current_chunk = ''
-                      other_word_fits = False
-                    if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                      use_small_font = True
-                    elif '<EMPHASIS>' in chunk_upper:
-                      is_emphasis = True
-                    elif '<STRONG>' in chunk_upper:
-                      is_strong = True
-                    elif '<CODE>' in chunk_upper or text_area[4].upper() == 'CODE':
-                      is_code = True
-
-                    if is_commentary:
-                      if use_small_font:
-                        font = co_font_small
-                      else:
-                        font = co_font
-
-                    if is_sign:
-                      if use_small_font:
-                        font = si_font_small
-                      else:
-                        font = si_font
-
-                    if is_formal:
-                      if use_small_font:
-                        font = fo_font_small
-                      else:
-                        font = fo_font
-
-                    if is_heading:
-                      if use_small_font:
-                        font = he_font_small
-                      else:
-                        font = he_font
-
-                    if is_letter:
-                      if use_small_font:
-                        font = le_font_small
-                      else:
-                        font = le_font
-
-                    if is_audio:
-                      if use_small_font:
-                        font = au_font_small
-                      else:
-                        font = au_font
-
-                    if is_thought:
-                      if use_small_font:
-                        font = th_font_small
-                      else:
-                        font = th_font
-
-                    if is_code:
-                      if use_small_font:
-                        font = c_font_small
-                      else:
-                        font = c_font
-
-                    if is_emphasis:
-                      if use_small_font:
-                        font = e_font_small
-                      else:
-                        font = e_font
-                    elif is_strong:
-                      if use_small_font:
-                        font = s_font_small
-                      else:
-                        font = s_font
-                    elif is_code:
-                      if use_small_font:
-                        font = c_font_small
-                      else:
-                        font = c_font
-
-                    if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                      use_small_font = False
-
-                    if '</EMPHASIS>' in chunk_upper:
-                      is_emphasis = False
-                    elif '</STRONG>' in chunk_upper:
-                      is_strong = False
-                    elif '</CODE>' in chunk_upper:
-                      is_code = False
-
-                    current_chunk = self.remove_xml_tags(chunk)
-                    if current_chunk != '':
-                      chunk_size = chunk_size + draw.textlength(current_chunk, font=font)
-                      font_box = font.getbbox(current_chunk)
-                      font_height = font_box[3] - font_box[1]
-
-                  text_size = (chunk_size, font_height + 1)
-                  upper_right_corner_fits = point_inside_polygon(current_pointer[0] + text_size[0], current_pointer[1], polygon)
-                  lower_right_corner_fits = point_inside_polygon(current_pointer[0] + text_size[0], current_pointer[1] + text_size[1], polygon)
-
-                  if other_word_fits and upper_right_corner_fits and lower_right_corner_fits:
-                    diff_ratio = (get_frame_span(polygon)[3] - (current_pointer[1] + text_size[1])) / float(text_size[1])
-                    if drawing_word == len(words) - 1 and diff_ratio > 1.45 and not is_formal and not is_commentary:
-                      #print words[drawing_word].encode("ascii","ignore")
-                      #print 'word y:', current_pointer[1] + text_size[1], current_pointer[1] + text_size[1]+ text_size[1]
-                      #print 'polygon:', get_frame_span(polygon)
-                      #print 'diff:', get_frame_span(polygon)[3] - (current_pointer[1] + text_size[1]), diff_ratio
-                      other_word_fits = False
-                      last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
-                      lines.append((first_word_start, current_line, last_word_end))
-                      current_line = ''
-                      first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
-                    else:
-                      current_line = current_line + words[drawing_word]
-                      #draw.rectangle((current_pointer[0], current_pointer[1], current_pointer[0] + text_size[0], current_pointer[1] + text_size[1]), outline='#ff0000')
-                      current_pointer = (current_pointer[0] + text_size[0], current_pointer[1])
-                      drawing_word = drawing_word + 1
-                  else:
-                    other_word_fits = False
-                    last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
-                    lines.append((first_word_start, current_line, last_word_end))
-                    current_line = ''
-                    first_word_start = (polygon_x_min + 2, first_word_start[1] + space_between_lines)
 
-              last_word_end = (current_pointer[0], current_pointer[1] + text_size[1])
-              lines.append((first_word_start, current_line, last_word_end))
-              
-              if character_height < 1:
-                text_fits = True
-
-
-          if '<CODE>' in lines[0][1].upper() or text_area[4].upper() == 'CODE':
-            text_areas_draw.append((character_height, lines, 'CODE', text_area[3], text_area[0], text_area[4], text_area[5]))
-          elif '<COMMENTARY>' in lines[0][1].upper() or text_area[4].upper() == 'COMMENTARY':
-            text_areas_draw.append((character_height, lines, 'COMMENTARY', text_area[3], text_area[0], text_area[4], text_area[5]))
+          if has_style(get_line_runs(lines[0][1], runs), 'code') or text_area[4].upper() == 'CODE':
+            text_areas_draw.append((character_height, lines, 'CODE', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
+          elif has_style(get_line_runs(lines[0][1], runs), 'commentary') or text_area[4].upper() == 'COMMENTARY':
+            text_areas_draw.append((character_height, lines, 'COMMENTARY', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'SIGN':
-            text_areas_draw.append((character_height, lines, 'SIGN', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'SIGN', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'FORMAL':
-            text_areas_draw.append((character_height, lines, 'FORMAL', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'FORMAL', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'HEADING':
-            text_areas_draw.append((character_height, lines, 'HEADING', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'HEADING', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'LETTER':
-            text_areas_draw.append((character_height, lines, 'LETTER', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'LETTER', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'AUDIO':
-            text_areas_draw.append((character_height, lines, 'AUDIO', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'AUDIO', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           elif text_area[4].upper() == 'THOUGHT':
-            text_areas_draw.append((character_height, lines, 'THOUGHT', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'THOUGHT', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
           else:
-            text_areas_draw.append((character_height, lines, 'SPEECH', text_area[3], text_area[0], text_area[4], text_area[5]))
+            text_areas_draw.append((character_height, lines, 'SPEECH', text_area[3], text_area[0], text_area[4], text_area[5], spans, runs))
 
           # rotate image back to original rotation after text is drawn
           if text_area[3] != 0:
@@ -668,7 +595,7 @@ class ComicPage():
             right = original_polygon_size[0] + left
             lower = original_polygon_size[1] + upper
             draw_image = draw_image.crop((left, upper, right, lower))
-            self.PILBackgroundImage.paste(draw_image, (original_polygon_boundaries[0], original_polygon_boundaries[1]), draw_image)
+            text_image.paste(draw_image, (original_polygon_boundaries[0], original_polygon_boundaries[1]), draw_image)
 
         # prepare draw
         speach_list = []
@@ -741,6 +668,7 @@ class ComicPage():
             # create new image from polygon size
             draw_image = Image.new('RGBA', (rotated_polygon_boundaries[2] - rotated_polygon_boundaries[0], rotated_polygon_boundaries[3] - rotated_polygon_boundaries[1]))
             draw = ImageDraw.Draw(draw_image)
+          spans = text_area[7]
 
           # normalize text size
           normalized_character_height = text_area[0]
@@ -763,181 +691,19 @@ class ComicPage():
           elif text_area[2] == 'THOUGHT' and text_area[0] / float(self.median(thought_list)) > 1.1:
             normalized_character_height = int(round(text_area[0] / 1.1, 0))
 
-          # load fonts
-          if current_character_height != normalized_character_height:
-            current_character_height = normalized_character_height
-            font = self.load_font('normal', current_character_height)
-            n_font = self.load_font('normal', current_character_height)
-            e_font = self.load_font('emphasis', current_character_height)
-            s_font = self.load_font('strong', current_character_height)
-            c_font = self.load_font('code', current_character_height)
-            co_font = self.load_font('commentary', current_character_height)
-            si_font = self.load_font('sign', current_character_height)
-            fo_font = self.load_font('formal', current_character_height)
-            he_font = self.load_font('heading', current_character_height)
-            le_font = self.load_font('letter', current_character_height)
-            au_font = self.load_font('audio', current_character_height)
-            th_font = self.load_font('thought', current_character_height)
-            n_font_small = self.load_font('normal', int(current_character_height/2))
-            e_font_small = self.load_font('emphasis', int(current_character_height/2))
-            s_font_small = self.load_font('strong', int(current_character_height/2))
-            c_font_small = self.load_font('code', int(current_character_height/2))
-            co_font_small = self.load_font('commentary', int(current_character_height/2))
-            si_font_small = self.load_font('sign', int(current_character_height/2))
-            fo_font_small = self.load_font('formal', int(current_character_height/2))
-            he_font_small = self.load_font('heading', int(current_character_height/2))
-            le_font_small = self.load_font('letter', int(current_character_height/2))
-            au_font_small = self.load_font('audio', int(current_character_height/2))
-            th_font_small = self.load_font('thought', int(current_character_height/2))
+          current_character_height = normalized_character_height
+          runs = text_area[8]
+          is_commentary = has_style(get_line_runs(text_area[1][0][1], runs), 'commentary') or text_area[2] == 'COMMENTARY'
+          base_style = get_base_style(text_area[2], is_commentary)
 
           # calculate new line length
           if normalized_character_height != text_area[0]:
             #print "normalized", text_area[0], normalized_character_height, text_area[1]
+            fonts = self.get_measure_fonts(runs, base_style, current_character_height)
             for line in text_area[1]:
-              # calculate some default values
-              text = line[1]
-              if '<COMMENTARY>' in text.upper() or text_area[2] == 'COMMENTARY':
-                is_commentary = True
-              else:
-                is_commentary = False
-
-              if text_area[2] == 'SIGN':
-                is_sign = True
-              else:
-                is_sign = False
-
-              if text_area[2] == 'FORMAL':
-                is_formal = True
-              else:
-                is_formal = False
-
-              if text_area[2] == 'HEADING':
-                is_heading = True
-              else:
-                is_heading = False
-
-              if text_area[2] == 'LETTER':
-                is_letter = True
-              else:
-                is_letter = False
-
-              if text_area[2] == 'AUDIO':
-                is_audio = True
-              else:
-                is_audio = False
-
-              if text_area[2] == 'THOUGHT':
-                is_thought = True
-              else:
-                is_thought = False
-
-              if text_area[2] == 'CODE':
-                is_code = True
-              else:
-                is_code = False
-              
-              is_emphasis = is_strong = False
-              words = text.replace('a href', 'a_href').replace(' ', ' ˇ').split('ˇ')
-              words_upper = text.replace(' ', 'ˇ').upper().split('ˇ')
-              drawing_word = 0
               line_length = 0
-
-              while drawing_word < len(words):
-                tag_split = words[drawing_word].replace('<', 'ˇ<').split('ˇ')
-                chunk_size = 0
-
-                for chunk in tag_split:
-                  chunk_upper = chunk.upper()
-                  if '<BR>' in chunk_upper:
-                    current_chunk = ''
-                  if '<SUP>' in chunk_upper or '<SUB>' in chunk_upper or '<A_HREF' in chunk_upper:
-                    use_small_font = True
-                  elif '<EMPHASIS>' in chunk_upper:
-                    is_emphasis = True
-                  elif '<STRONG>' in chunk_upper:
-                    is_strong = True
-                  elif '<CODE>' in chunk_upper:
-                    is_code = True
-
-                  if is_commentary:
-                    if use_small_font:
-                      font = co_font_small
-                    else:
-                      font = co_font
-
-                  if is_sign:
-                    if use_small_font:
-                      font = si_font_small
-                    else:
-                      font = si_font
-
-                  if is_formal:
-                    if use_small_font:
-                      font = fo_font_small
-                    else:
-                      font = fo_font
-
-                  if is_heading:
-                    if use_small_font:
-                      font = he_font_small
-                    else:
-                      font = he_font
-
-                  if is_letter:
-                    if use_small_font:
-                      font = le_font_small
-                    else:
-                      font = le_font
-
-                  if is_audio:
-                    if use_small_font:
-                      font = au_font_small
-                    else:
-                      font = au_font
-
-                  if is_thought:
-                    if use_small_font:
-                      font = th_font_small
-                    else:
-                      font = th_font
-
-                  if is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if is_emphasis:
-                    if use_small_font:
-                      font = e_font_small
-                    else:
-                      font = e_font
-                  elif is_strong:
-                    if use_small_font:
-                      font = s_font_small
-                    else:
-                      font = s_font
-                  elif is_code:
-                    if use_small_font:
-                      font = c_font_small
-                    else:
-                      font = c_font
-
-                  if '</SUP>' in chunk_upper or '</SUB>' in chunk_upper or '</A>' in chunk_upper:
-                    use_small_font = False
-
-                  if '</EMPHASIS>' in chunk_upper:
-                    is_emphasis = False
-                  elif '</STRONG>' in chunk_upper:
-                    is_strong = False
-                  elif '</CODE>' in chunk_upper:
-                    is_code = False
-
-                  current_chunk = self.remove_xml_tags(chunk)
-                  if current_chunk != '':
-                    chunk_size = chunk_size + draw.textlength(current_chunk, font=font)
-                drawing_word = drawing_word + 1
-                line_length = line_length + chunk_size
+              for word in line[1]:
+                line_length = line_length + self.measure_word(draw, word, runs, fonts, 0)[0]
               change_in_height = int(round((((line[2][1] - line[0][1]) - (current_character_height + 1)) / 2), 0))
               lines.append(((line[0][0], line[0][1] - change_in_height), line[1], (line[0][0] + line_length, line[0][1] + current_character_height + 1 - change_in_height)))
           else:
@@ -962,9 +728,9 @@ class ComicPage():
               for move in range(vertical_move, 1, -1):
                 is_inside = True
                 for line in lines:
-                  if not point_inside_polygon(line[0][0], line[0][1] + move + int(current_character_height / 5), polygon):
+                  if not spans.contains(line[0][0], line[0][1] + move + int(current_character_height / 5)):
                     is_inside = False
-                  elif not point_inside_polygon(line[2][0], line[2][1] + move + int(current_character_height / 5), polygon):
+                  elif not spans.contains(line[2][0], line[2][1] + move + int(current_character_height / 5)):
                     #draw.rectangle((line[0][0], line[0][1], line[2][0], line[2][1] + move), outline="#FFFFFF")
                     is_inside = False
                 if is_inside:
@@ -978,225 +744,63 @@ class ComicPage():
                   #draw.rectangle((line[0][0], line[0][1] + vertical_move, line[2][0], line[2][1] + vertical_move), outline="#FFFFFF")
 
                   #realign to left
-                  min_coordinate_set = False
-                  current_coordinate = line[0][0]
-                  min_coordinate = line[0][0] - 2
-                  while min_coordinate_set == False:
-                    if (point_inside_polygon(current_coordinate, line[0][1] + int(current_character_height/2), polygon) and
-                        point_inside_polygon(current_coordinate, line[2][1], polygon)):
-                      min_coordinate = current_coordinate
-                    else:
-                      min_coordinate_set = True
-                    current_coordinate = current_coordinate - 2
+                  min_coordinate = spans.walk(line[0][0], (line[0][1] + int(current_character_height/2), line[2][1]), -2)
+                  if min_coordinate is None:
+                    min_coordinate = line[0][0] - 2
                   lines[idx] = ((min_coordinate + 2, line[0][1] + vertical_move - 1), line[1], (line[2][0] - (line[0][0] - min_coordinate), line[2][1] + vertical_move - 1))
                   #draw.rectangle((min_coordinate + 2, line[0][1] + vertical_move, line[2][0] - (line[0][0] - min_coordinate), line[2][1] + vertical_move), outline="#FF0000")
 
 
-          if '<COMMENTARY>' in lines[0][1].upper() or text_area[2] == 'COMMENTARY':
-            is_commentary = True
-          else:
-            is_commentary = False
-
-          if text_area[2] == 'SIGN':
-            is_sign = True
-          else:
-            is_sign = False
-
-          if text_area[2] == 'FORMAL':
-            is_formal = True
-          else:
-            is_formal = False
-
-          if text_area[2] == 'HEADING':
-            is_heading = True
-          else:
-            is_heading = False
-
-          if text_area[2] == 'LETTER':
-            is_letter = True
-          else:
-            is_letter = False
-
-          if text_area[2] == 'AUDIO':
-            is_audio = True
-          else:
-            is_audio = False
-
-          if text_area[2] == 'THOUGHT':
-            is_thought = True
-          else:
-            is_thought = False
-
-          if text_area[2] == 'CODE':
-            is_code = True
-          else:
-            is_code = False
-
           #drawing
-          font = n_font
-          font_small = n_font_small
-          font_color = self.font_color_default
-          strikethrough_word = False
-          use_small_font = False
-          use_superscript = False
-          use_subscript = False
-
-          if is_commentary:
-            font = co_font
-            font_small = co_font_small
-            font_color = self._window.acbf_document.font_colors['commentary']
-          elif is_sign:
-            font = si_font
-            font_small = si_font_small
-            font_color = self._window.acbf_document.font_colors['sign']
-          elif is_formal:
-            font = fo_font
-            font_small = fo_font_small
-            font_color = self._window.acbf_document.font_colors['formal']
-          elif is_heading:
-            font = he_font
-            font_small = he_font_small
-            font_color = self._window.acbf_document.font_colors['heading']
-          elif is_letter:
-            font = le_font
-            font_small = le_font_small
-            font_color = self._window.acbf_document.font_colors['letter']
-          elif is_audio:
-            font = au_font
-            font_small = au_font_small
-            font_color = self._window.acbf_document.font_colors['audio']
-          elif is_thought:
-            font = th_font
-            font_small = th_font_small
-            font_color = self._window.acbf_document.font_colors['thought']
-          elif is_code:
-            font = c_font
-            font_small = c_font_small
-            font_color = self._window.acbf_document.font_colors['code']
-
-          # idetify last line in paragraph
           for idx, line in enumerate(lines):
-            if '<BR>' in line[1]:
-              lines[idx] = (line[0], line[1].replace('<BR>', ''), line[2])
-              lines[idx-1] = (lines[idx-1][0], '<BR>' + lines[idx-1][1], lines[idx-1][2])
-          
-          for idx, line in enumerate(lines):
-            is_last_line = False
+            # last line in paragraph is followed by line starting new paragraph
+            is_last_line = idx + 1 < len(lines) and len(lines[idx + 1][1]) > 0 and lines[idx + 1][1][0][1]
             old_line = ''
             current_pointer = line[0]
             #draw.rectangle((line[0][0], line[0][1], line[2][0], line[2][1]), outline="#FFFFFF")
-            max_coordinate_set = False
-            max_coordinate = line[2][0]
-            current_coordinate = line[2][0]
 
             # get max line length
-            while max_coordinate_set == False:
-              if (point_inside_polygon(current_coordinate, current_pointer[1] + int(current_character_height/2), polygon) and
-                  point_inside_polygon(current_coordinate, line[2][1], polygon)):
-                max_coordinate = current_coordinate
-              else:
-                max_coordinate_set = True
-              current_coordinate = current_coordinate + 2
-
-            # split by tags
-            tag_split = line[1].split('<')
-            for i in range(len(tag_split)):
-              if i > 0:
-                tag_split[i] = '<' + tag_split[i]
+            max_coordinate = spans.walk(line[2][0], (current_pointer[1] + int(current_character_height/2), line[2][1]), 2)
+            if max_coordinate is None:
+              max_coordinate = line[2][0]
 
-            for chunk in tag_split:
-              chunk_upper = chunk.upper()
+            for run_index, current_word in get_line_chunks(line[1]):
+              style, use_small_font, link = runs[run_index][1:]
 
-              if '<BR>' in chunk_upper:
-                is_last_line = True
-
-              if '<INVERTED>' in chunk_upper or text_area[6]:
+              if 'inverted' in style or text_area[6]:
                 font_color = self.font_color_inverted
-                text_area = (text_area[0], text_area[1], text_area[2], text_area[3], text_area[4], text_area[5], True)
-              elif '</INVERTED>' in chunk_upper:
-                font_color = self._window.acbf_document.font_colors[text_area[2].lower()]
-              elif not text_area[6]:
+              else:
                 font_color = self._window.acbf_document.font_colors[text_area[2].lower()]
 
-              if '<EMPHASIS>' in chunk_upper:
-                font = e_font
-                font_small = e_font_small
-              elif '<STRONG>' in chunk_upper:
-                font = s_font
-                font_small = s_font_small
-              elif '<CODE>' in chunk_upper:
-                font = c_font
-                font_small = c_font_small
-              elif '<STRIKETHROUGH>' in chunk_upper:
-                strikethrough_word = True
-              elif '</EMPHASIS>' in chunk_upper or '</STRONG>' in chunk_upper or '</CODE>' in chunk_upper:
-                if is_commentary:
-                  font = co_font
-                  font_small = co_font_small
-                elif is_sign:
-                  font = si_font
-                  font_small = si_font_small
-                elif is_formal:
-                  font = fo_font
-                  font_small = fo_font_small
-                elif is_heading:
-                  font = he_font
-                  font_small = he_font_small
-                elif is_letter:
-                  font = le_font
-                  font_small = le_font_small
-                elif is_audio:
-                  font = au_font
-                  font_small = au_font_small
-                elif is_thought:
-                  font = th_font
-                  font_small = th_font_small
-                elif is_code:
-                  font = c_font
-                  font_small = c_font_small
-                else:
-                  font = n_font
-                  font_small = n_font_small
-              elif '</STRIKETHROUGH>' in chunk_upper:
-                strikethrough_word = False
-              elif '</SUP>' in chunk_upper:
-                use_superscript = False
-                use_small_font = False
-              elif '</SUB>' in chunk_upper:
-                use_subscript = False
-                use_small_font = False
-              elif '</A>' in chunk_upper:
-                use_small_font = False
-              elif '<SUP>' in chunk_upper or '<A_HREF' in chunk_upper:
-                use_small_font = True
-                use_superscript = True
-              elif '<SUB>' in chunk_upper:
-                use_small_font = True
-                use_subscript = True
+              run_style = get_run_style(runs[run_index], base_style)
+              font = self.load_font(run_style, current_character_height)
+              font_small = self.load_font(run_style, int(current_character_height/2))
+              # fonts are shared between styles using the same font file, so emphasis is tracked separately
+              emphasized = run_style in ('emphasis', 'strong')
+              strikethrough_word = 'strikethrough' in style
+              script = get_innermost_style(style, ('sup', 'sub', 'a'))
+              use_superscript = script in ('sup', 'a')
+              use_subscript = script == 'sub'
 
               if len(font_color) == 13:
                 font_color = '#' + font_color[1:3] + font_color[5:7] + font_color[9:11]
-              
-              current_word = self.remove_xml_tags(chunk)
-              if current_word == '':
-                continue
 
               # align the text
               if old_line != line:
                 justify_space = 0
                 if is_commentary or (text_area[5].upper() == 'FORMAL' and idx + 1 == len(lines)): #left align
-                  space_between_words = draw.textlength(' ', font=font)
+                  space_between_words = text_measures.length(draw, ' ', font=font)
                 elif text_area[5].upper() == 'FORMAL': #justify
-                  w_count = len(line[1].strip().split(' ')) - 1
+                  w_count = len(get_line_text(line[1]).strip().split(' ')) - 1
                   if is_last_line:
                     justify_space = 0
                   elif w_count > 0:
                     justify_space = (max_coordinate - line[2][0]) / w_count
                   else:
                     justify_space = 0
-                  space_between_words = draw.textlength(' ', font=font) + justify_space
+                  space_between_words = text_measures.length(draw, ' ', font=font) + justify_space
                 else: #center
-                  space_between_words = draw.textlength('n n', font=font) - draw.textlength('nn', font=font)
+                  space_between_words = text_measures.length(draw, 'n n', font=font) - text_measures.length(draw, 'nn', font=font)
                   line_length = line[2][0] - line[0][0]
                   mid_bubble_x = ((get_frame_span(text_area[4])[0] + get_frame_span(text_area[4])[2]) / 2) - line_length / 2
                   max_coordinate_x = current_pointer[0] + int((max_coordinate - line[2][0])/2)
@@ -1227,33 +831,33 @@ class ComicPage():
                 elif use_superscript:
                   draw.text(current_pointer, current_word, font=font_small, fill=font_color)
                   #draw.rectangle((current_pointer[0] - 1, current_pointer[1] - 1, current_pointer[0] + draw.textlength(current_word, font=font_small) + 1, current_pointer[1] + int(character_height * 0.7) + 1), outline=font_color)
-                  if '<A_HREF' in chunk_upper:
-                    reference_id = re.sub("[^#]*#", '', chunk)
-                    reference_id = re.sub("\".*", '', reference_id)
+                  if link is not None:
                     for idxr, reference in enumerate(self.references):
-                      if reference_id == reference[0]:
+                      if link == reference[0]:
                         rectangle = [(current_pointer[0] - 5, current_pointer[1] - 5),
-                                     (current_pointer[0] + draw.textlength(current_word, font=font_small) + 5, current_pointer[1] - 5),
-                                     (current_pointer[0] + draw.textlength(current_word, font=font_small) + 5, current_pointer[1] + int(current_character_height * 0.7) + 5),
+                                     (current_pointer[0] + text_measures.length(draw, current_word, font=font_small) + 5, current_pointer[1] - 5),
+                                     (current_pointer[0] + text_measures.length(draw, current_word, font=font_small) + 5, current_pointer[1] + int(current_character_height * 0.7) + 5),
                                      (current_pointer[0] - 5, current_pointer[1] + int(current_character_height * 0.7) + 5)]
                         self.references[idxr] = (reference[0], reference[1], rectangle)
             
-                text_size = (draw.textlength(current_word, font=font_small), int(current_character_height * 0.5))
+                text_size = (text_measures.length(draw, current_word, font=font_small), int(current_character_height * 0.5))
                 strikethrough_rectangle = [current_pointer[0] - int(space_between_words/2),
                                            current_pointer[1] + int(current_character_height/2) + 1,
                                            current_pointer[0] + text_size[0] + int(space_between_words/2),
                                            current_pointer[1] + int(current_character_height/2) + 1 - int(current_character_height/10)]
 
                 current_pointer = (current_pointer[0] + text_size[0], current_pointer[1])
+                if text_area[5].upper() == 'FORMAL':
+                  current_pointer = (current_pointer[0] + justify_space * current_word.count(' '), current_pointer[1])
 
               else:
                 word_start = current_pointer
                 text_size = [0, current_character_height]
                 word_count = len(current_word.strip().split(' '))
-                line_length_total = draw.textlength(current_word.strip(), font=font)
+                line_length_total = text_measures.length(draw, current_word.strip(), font=font)
                 word_length_total = 0
                 for one_word in current_word.split(' '):
-                  word_length_total = word_length_total + draw.textlength(one_word.strip(), font=font)
+                  word_length_total = word_length_total + text_measures.length(draw, one_word.strip(), font=font)
 
                 space_length = line_length_total - word_length_total
                 if word_count > 1:
@@ -1261,26 +865,28 @@ class ComicPage():
                 elif space_length > 0:
                   one_space = space_length
                 else:
-                  one_space = draw.textlength(current_word + ' M', font=font) - draw.textlength(current_word + 'M', font=font)
+                  one_space = text_measures.length(draw, current_word + ' M', font=font) - text_measures.length(draw, current_word + 'M', font=font)
 
                 #print '#' + current_word.encode('ascii', 'ignore') + '#', line_length_total, word_length_total, space_length, one_space
                 
-                for one_word in current_word.split(' '):
+                one_words = current_word.split(' ')
+                for word_idx, one_word in enumerate(one_words):
                   if one_word == '':
                     continue
                   if one_word[0].upper() == 'J' and text_area[5].upper() != 'FORMAL': #dirty fix
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
-                  elif font == e_font or font == s_font:
+                  elif emphasized:
                     current_pointer = (current_pointer[0] - 1, current_pointer[1])
                   draw.text(current_pointer, one_word + ' ', font=font, fill=font_color)
-                  word_length = max(draw.textlength(one_word.strip(), font=font) + one_space, draw.textlength(one_word.strip() + ' ', font=font))
-                  if text_area[5].upper() == 'FORMAL':
+                  word_length = max(text_measures.length(draw, one_word.strip(), font=font) + one_space, text_measures.length(draw, one_word.strip() + ' ', font=font))
+                  # justify spaces go between words only, not where word continues with next run (e.g. superscript)
+                  if text_area[5].upper() == 'FORMAL' and word_idx < len(one_words) - 1:
                     word_length = word_length + justify_space
                   text_size = (text_size[0] + word_length, current_character_height)
                   current_pointer = (current_pointer[0] + word_length, current_pointer[1])
                   if one_word[-1].upper() == 'J' and text_area[5].upper() != 'FORMAL': #dirty fix:
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
-                  elif font == e_font or font == s_font:
+                  elif emphasized:
                     current_pointer = (current_pointer[0] + 1, current_pointer[1])
                   
                 #draw.text(current_pointer, current_word, font=font, fill=font_color)
@@ -1303,19 +909,306 @@ class ComicPage():
             right = original_polygon_size[0] + left
             lower = original_polygon_size[1] + upper
             draw_image = draw_image.crop((left, upper, right, lower))
-            self.PILBackgroundImage.paste(draw_image, (original_polygon_boundaries[0], original_polygon_boundaries[1]), draw_image)
+            text_image.paste(draw_image, (original_polygon_boundaries[0], original_polygon_boundaries[1]), draw_image)
 
         try:
           del draw
         except:
           None
 
+        # keep pixels changed by text layer only, so it can be composited over page image
+        diff_bands = ImageChops.difference(text_image, self.PILBackgroundImage.convert('RGB')).split()
+        mask = ImageChops.lighter(ImageChops.lighter(diff_bands[0], diff_bands[1]), diff_bands[2]).point(lambda v: 255 if v else 0)
+        bbox = mask.getbbox()
+        if bbox is None:
+          return None, (0, 0)
+        overlay = text_image.crop(bbox)
+        overlay.putalpha(mask.crop(bbox))
+        return overlay, (bbox[0], bbox[1])
+
+class RenderCache():
+
+    """Keeps recently rendered pages (PixBuf and processed PIL image) and text layers within memory budget
+       (render_cache_size preference in MB), least recently used pages are dropped first."""
+
+    def __init__(self, preferences):
+        self.pages = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.set_size_limit(int(preferences.get_value("render_cache_size")))
+
+    def set_size_limit(self, size_limit):
+        with self.lock:
+          self.size_limit = size_limit * 1024 * 1024
+          self.evict()
+
+    def get(self, key):
+        with self.lock:
+          if key not in self.pages:
+            return None
+          self.pages.move_to_end(key)
+          return self.pages[key][0]
+
+    def put(self, key, rendered, size):
+        with self.lock:
+          if key in self.pages:
+            self.size = self.size - self.pages.pop(key)[1]
+          if size > self.size_limit:
+            return
+          self.pages[key] = (rendered, size)
+          self.size = self.size + size
+          self.evict()
+
+    def evict(self):
+        while self.size > self.size_limit:
+          key, (rendered, size) = self.pages.popitem(last=False)
+          self.size = self.size - size
+
+    def clear(self):
+        with self.lock:
+          self.pages.clear()
+          self.size = 0
+
+class TextMeasureCache():
+
+    """Keeps (font file, size, text) -> (length, height) measurements of text laid out on pages of a book,
+       least recently used ones are dropped over TEXT_MEASURES_CACHE_SIZE."""
+
+    def __init__(self):
+        self.measures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def measure(self, draw, text, font):
+        """Returns length of text drawn with font and height of its bounding box."""
+        # fonts loaded from memory (default font) have no file to identify them by
+        if not isinstance(getattr(font, 'path', None), str):
+          return measure_text(draw, text, font)
+        key = (font.path, font.size, text)
+        with self.lock:
+          if key in self.measures:
+            self.measures.move_to_end(key)
+            return self.measures[key]
+        measure = measure_text(draw, text, font)
+        with self.lock:
+          self.measures[key] = measure
+          if len(self.measures) > constants.TEXT_MEASURES_CACHE_SIZE:
+            self.measures.popitem(last=False)
+        return measure
+
+    def length(self, draw, text, font):
+        return self.measure(draw, text, font)[0]
+
+    def clear(self):
+        with self.lock:
+          self.measures.clear()
+
+class Prefetcher():
+
+    """Renders pages around current page into RenderCache in background threads.
+       Jobs scheduled before last schedule/cancel call are skipped."""
+
+    def __init__(self, window):
+        self._window = window
+        self.generation = 0
+        self.futures = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    def schedule(self):
+        self.cancel(wait=False)
+        if not self._window.acbf_document.valid or self._window.render_cache.size_limit == 0:
+          return
+        page_number = self._window.page_number
+        pages_count = self._window.acbf_document.pages_total + 1
+        next_pages = []
+        for page in range(page_number + 1, min(page_number + constants.PREFETCH_NEXT_PAGES, pages_count) + 1):
+          next_pages.append((page, 1))
+        previous_pages = []
+        for page in range(page_number - 1, max(page_number - constants.PREFETCH_PREVIOUS_PAGES, 1) - 1, -1):
+          # previous page is entered on its last frame
+          previous_pages.append((page, max(len(self._window.acbf_document.load_page_frames(page)), 1)))
+        # nearest pages first
+        pages = []
+        for idx in range(max(len(next_pages), len(previous_pages))):
+          pages = pages + next_pages[idx:idx + 1] + previous_pages[idx:idx + 1]
+        # worker threads must not touch widgets or window state changed meanwhile
+        view = (self._window.toolbar.language.get_active(), self._window.zoom_level, tuple(self._window.drawable_size))
+        for page, frame in pages:
+          self.futures.append(self.executor.submit(self.prefetch_page, self.generation, page, frame, self._window.comic_page.rotation, view))
+
+    def prefetch_page(self, generation, page_number, frame_number, rotation, view):
+        try:
+          if generation != self.generation:
+            return
+          language, zoom_level, drawable_size = view
+          comic_page = ComicPage(self._window, page_number, frame_number, language, zoom_level, drawable_size)
+          comic_page.rotation = rotation
+          comic_page.update()
+          if generation != self.generation:
+            return
+          if zoom_level == 3 and comic_page.frames_total == 0:
+            zoom_level = 1
+          get_PixBufImage(comic_page, drawable_size, zoom_level)
+        except Exception as inst:
+          print("Unable to prefetch page %d: %s" % (page_number, inst))
+
+    def cancel(self, wait=True):
+        """Drops scheduled jobs, waits for running ones to finish if wait is set."""
+        self.generation = self.generation + 1
+        for future in self.futures:
+          future.cancel()
+        if wait:
+          concurrent.futures.wait(self.futures)
+        self.futures = []
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown()
+
+class PolygonSpans():
+
+    """Scanline table of text-area polygon: sorted x coordinates where polygon edges cross each row.
+       Point lies inside when odd number of crossings is at or right of it (same rule as point_inside_polygon),
+       so inside spans of a row with crossings xs are (xs[i-1], xs[i]] for odd len(xs) - i."""
+
+    def __init__(self, polygon):
+        points = numpy.array(polygon, dtype=numpy.float64)
+        self.p1x = points[:, 0]
+        self.p1y = points[:, 1]
+        self.p2x = numpy.roll(self.p1x, -1)
+        self.p2y = numpy.roll(self.p1y, -1)
+        self.rows = {}
+        y_min = int(math.floor(self.p1y.min()))
+        y_max = int(math.ceil(self.p1y.max()))
+        for y, row in zip(range(y_min, y_max + 1), self.get_crossings(numpy.arange(y_min, y_max + 1, dtype=numpy.float64))):
+          self.rows[y] = row
+
+    def get_crossings(self, ys):
+        """Returns list of sorted crossings for each of rows ys."""
+        ys = ys[:, numpy.newaxis]
+        mask = (ys > numpy.minimum(self.p1y, self.p2y)) & (ys <= numpy.maximum(self.p1y, self.p2y))
+        dy = numpy.where(self.p1y == self.p2y, 1, self.p2y - self.p1y)
+        xinters = (ys - self.p1y) * (self.p2x - self.p1x) / dy + self.p1x
+        # edge is crossed only left of its right end
+        crossings = numpy.where(mask, numpy.minimum(xinters, numpy.maximum(self.p1x, self.p2x)), numpy.inf)
+        crossings.sort(axis=1)
+        rows = []
+        for row, count in zip(crossings, mask.sum(axis=1)):
+          rows.append(row[:count].tolist())
+        return rows
+
+    def get_row(self, y):
+        if y not in self.rows:
+          self.rows[y] = self.get_crossings(numpy.array([y], dtype=numpy.float64))[0]
+        return self.rows[y]
+
+    def contains(self, x, y):
+        xs = self.get_row(y)
+        return (len(xs) - bisect.bisect_left(xs, x)) % 2 == 1
+
+    def outside_until(self, x, y):
+        """Returns right end of outside span point x, y lies in (None if it reaches beyond polygon)."""
+        xs = self.get_row(y)
+        idx = bisect.bisect_left(xs, x)
+        if idx == len(xs):
+          return None
+        return xs[idx]
+
+    def walk(self, x, ys, step):
+        """Returns last of points x, x + step, x + 2*step, ... lying inside all rows ys
+           before first one that does not (None if x itself is outside)."""
+        steps = None
+        for y in ys:
+          xs = self.get_row(y)
+          idx = bisect.bisect_left(xs, x)
+          if (len(xs) - idx) % 2 == 0:
+            return None
+          if step > 0:
+            row_steps = int(math.floor((xs[idx] - x) / step))
+          else:
+            row_steps = int(math.ceil((x - xs[idx - 1]) / -step)) - 1
+          if steps is None or row_steps < steps:
+            steps = row_steps
+
+        # correct rounding of span ends
+        steps = max(steps, 0)
+        while all(self.contains(x + step * (steps + 1), y) for y in ys):
+          steps = steps + 1
+        while steps > 0 and not all(self.contains(x + step * steps, y) for y in ys):
+          steps = steps - 1
+        return x + step * steps
+
+    def find_place(self, x, y, width, height, x_max, y_max):
+        """Finds first place for box of given size with all corners inside polygon, trying positions
+           2px apart from x to the right (while box ends before x_max) and then 2px lower rows.
+           Returns (x, y) of the place or None if there is none above y_max."""
+        while True:
+          if y + height > y_max:
+            if self.contains_box(x, y, width, height):
+              return (x, y)
+            return None
+          place_x = self.find_place_in_row(x, y, width, height, x_max)
+          if place_x is not None:
+            return (place_x, y)
+          y = y + 2
+
+    def contains_box(self, x, y, width, height):
+        return (self.contains(x, y) and self.contains(x + width, y) and
+                self.contains(x, y + height) and self.contains(x + width, y + height))
+
+    def find_place_in_row(self, x, y, width, height, x_max):
+        step = 0
+        while True:
+          place_x = x + 2 * step
+          if step > 0 and place_x - 2 + width > x_max:
+            return None
+          for offset, corner_x, corner_y in ((0, place_x, y), (width, place_x + width, y),
+                                             (0, place_x, y + height), (width, place_x + width, y + height)):
+            if not self.contains(corner_x, corner_y):
+              break
+          else:
+            return place_x
+
+          # skip positions where the corner stays outside
+          span_end = self.outside_until(corner_x, corner_y)
+          if span_end is None:
+            return None
+          next_step = max(int(math.floor((span_end - offset - x) / 2)), step)
+          while x + 2 * next_step + offset <= span_end:
+            next_step = next_step + 1
+          step = next_step
+
+# held while drawing text layer with fonts from get_font
+fonts_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=constants.FONTS_CACHE_SIZE)
+def get_font(font_path, size):
+    """Returns font loaded from file, recently used (font, size) pairs are shared by all pages and books."""
+    return ImageFont.truetype(font_path, size)
+
 # Image manipulation
+def measure_text(draw, text, font):
+    font_box = font.getbbox(text)
+    return draw.textlength(text, font=font), font_box[3] - font_box[1]
+
 def get_PixBufImage(ComicPageObject, size, zoom_level):
     """Returns final PixBuf image for the main window, its width and height"""
-    frame_color = ComicPageObject.bg_color
+    frame_color = ComicPageObject.get_frame_color(zoom_level)
+    render_key = ComicPageObject.get_render_key(size, zoom_level)
+    rendered = ComicPageObject._window.render_cache.get(render_key)
+    if rendered is not None:
+      PixBufImage, ComicPageObject.PILBackgroundImageProcessed, references = rendered
+      ComicPageObject.references = list(references)
+      ComicPageObject.updated = True
+      return PixBufImage, PixBufImage.get_width(), PixBufImage.get_height(), frame_color
+
     try:
-      cpPILBackgroundImage = ComicPageObject.PILBackgroundImage.copy()
+      if ComicPageObject.text_layer_shown:
+        cpPILBackgroundImage = ComicPageObject.PILBackgroundImage.convert('RGB')
+        overlay, position = ComicPageObject.get_text_layer()
+        if overlay is not None:
+          cpPILBackgroundImage.paste(overlay, position, overlay)
+      else:
+        cpPILBackgroundImage = ComicPageObject.PILBackgroundImage.copy()
 
       # remove borders
       if (ComicPageObject._window.preferences.get_value("crop_border") == "True" and zoom_level == 2):
@@ -1336,7 +1229,7 @@ def get_PixBufImage(ComicPageObject, size, zoom_level):
       if (zoom_level == 3 and ComicPageObject.frames_total > 0):
         # get frame polygon coordinates and color
         #frame_coordinates = ComicPageObject.frames[ComicPageObject._window.frame_number - 1][0]
-        frame_color = ComicPageObject.frames[ComicPageObject._window.frame_number - 1][1]
+        frame_color = ComicPageObject.frames[ComicPageObject.get_frame_number() - 1][1]
         if frame_color == None:
            frame_color = ComicPageObject.bg_color
 
@@ -1360,7 +1253,7 @@ def get_PixBufImage(ComicPageObject, size, zoom_level):
 
       # calculate image_ratio and drawable_size_ratio
       image_ratio = cpPILBackgroundImage.size[0]/cpPILBackgroundImage.size[1]
-      drawable_size_ratio = ComicPageObject._window.drawable_size[0]/ComicPageObject._window.drawable_size[1]
+      drawable_size_ratio = ComicPageObject.get_drawable_size()[0]/ComicPageObject.get_drawable_size()[1]
 
       if image_ratio >= 1:
         image_ratio = 1
@@ -1444,27 +1337,29 @@ def get_PixBufImage(ComicPageObject, size, zoom_level):
       return None, 0, 0, ComicPageObject.bg_color
 
     ComicPageObject.PILBackgroundImageProcessed = cpPILBackgroundImage.copy()
+    ComicPageObject._window.render_cache.put(render_key, (PixBufImage, ComicPageObject.PILBackgroundImageProcessed, list(ComicPageObject.references)),
+                                             PixBufImage.get_rowstride()*PixBufImage.get_height() +
+                                             cpPILBackgroundImage.size[0]*cpPILBackgroundImage.size[1]*len(cpPILBackgroundImage.getbands()))
 
     return PixBufImage, PixBufImage.get_width(), PixBufImage.get_height(), frame_color
 
 def pil_to_pixbuf(PILImage, BGColor):
-    """Return a pixbuf created from the PIL <image>."""
-
-    bcolor = (int(Gdk.color_parse(BGColor).red_float*255), int(Gdk.color_parse(BGColor).green_float*255), int(Gdk.color_parse(BGColor).blue_float*255))
-
-    PILImage = PILImage.convert("RGBA")
-    bg = Image.new("RGB", PILImage.size, bcolor)
-    bg.paste(PILImage,PILImage)
-
-    with io.BytesIO() as dummy_file:
-      bg.save(dummy_file, "ppm")
-      contents = dummy_file.getvalue()
+    """Return a pixbuf created from the PIL <image>, transparent parts are filled with BGColor."""
+    if PILImage.mode != "RGB":
+      if PILImage.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in PILImage.info:
+        color = Gdk.color_parse(BGColor)
+        bcolor = (int(color.red_float*255), int(color.green_float*255), int(color.blue_float*255))
+        PILImage = PILImage.convert("RGBA")
+        bg = Image.new("RGB", PILImage.size, bcolor)
+        bg.paste(PILImage, PILImage)
+        PILImage = bg
+      else:
+        PILImage = PILImage.convert("RGB")
 
-    loader = GdkPixbuf.PixbufLoader()
-    loader.write(contents)
-    pixbuf = loader.get_pixbuf()
-    loader.close()
-    return pixbuf
+    # pixbuf is built from raw RGB data of the image (rows are not padded)
+    width, height = PILImage.size
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(PILImage.tobytes()), GdkPixbuf.Colorspace.RGB,
+                                           False, 8, width, height, width * 3)
 
 def get_frame_span(frame_coordinates):
     """returns x_min, y_min, x_max, y_max coordinates of a frame"""
@@ -1483,6 +1378,89 @@ def get_frame_span(frame_coordinates):
         y_max = frame_tuple[1]
     return (int(x_min), int(y_min), int(x_max), int(y_max))
 
+def get_words(paragraphs):
+    """Splits text runs of text-area paragraphs into words, each keeping its trailing space.
+    Returns list of runs and list of words (pieces, paragraph_start), pieces being (run_index, text) tuples."""
+    runs = []
+    words = []
+    pieces = []
+    paragraph_start = False
+    for idx, paragraph in enumerate(paragraphs):
+      paragraph = list(paragraph)
+      if idx < len(paragraphs) - 1:
+        # paragraphs are separated by space
+        if len(paragraph) > 0 and paragraph[-1][1] == ():
+          paragraph[-1] = (paragraph[-1][0] + ' ',) + paragraph[-1][1:]
+        else:
+          paragraph.append((' ', (), False, None))
+      if idx > 0:
+        paragraph_start = True
+      for run in paragraph:
+        run_index = len(runs)
+        runs.append(run)
+        parts = run[0].split(' ')
+        for part in parts[:-1]:
+          pieces.append((run_index, part + ' '))
+          words.append((pieces, paragraph_start))
+          pieces = []
+          paragraph_start = False
+        if parts[-1] != '':
+          pieces.append((run_index, parts[-1]))
+    words.append((pieces, paragraph_start))
+    return runs, words
+
+def get_line_text(words):
+    text = ''
+    for word in words:
+      for run_index, piece in word[0]:
+        text = text + piece
+    return text
+
+def get_line_runs(words, runs):
+    line_runs = []
+    for word in words:
+      for run_index, piece in word[0]:
+        line_runs.append(runs[run_index])
+    return line_runs
+
+def get_line_chunks(words):
+    """Joins pieces of line words belonging to the same run, returns list of (run_index, text) tuples."""
+    chunks = []
+    for word in words:
+      for run_index, piece in word[0]:
+        if len(chunks) > 0 and chunks[-1][0] == run_index:
+          chunks[-1] = (run_index, chunks[-1][1] + piece)
+        else:
+          chunks.append((run_index, piece))
+    return chunks
+
+def has_style(runs, tag):
+    for run in runs:
+      if tag in run[1]:
+        return True
+    return False
+
+def get_innermost_style(style, tags):
+    for tag in reversed(style):
+      if tag in tags:
+        return tag
+    return None
+
+def get_base_style(area_type, is_commentary):
+    """Returns font style of text-area type (type attribute in upper case)."""
+    if is_commentary:
+      return 'commentary'
+    elif area_type in ('SIGN', 'FORMAL', 'HEADING', 'LETTER', 'AUDIO', 'THOUGHT', 'CODE'):
+      return area_type.lower()
+    return 'normal'
+
+def get_run_style(run, base_style):
+    """Returns font style of text run (emphasis, strong or code tag or base style of text-area)."""
+    style = get_innermost_style(run[1], ('emphasis', 'strong', 'code'))
+    if style is None:
+      return base_style
+    return style
+
 def point_inside_polygon(x,y,poly):
     n = len(poly)
     inside = False
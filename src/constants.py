@@ -35,6 +35,22 @@ DATA_DIR = portability.get_data_directory()
 FONTS_DIR = portability.get_fonts_directory()
 PLATFORM = portability.get_platform()
 
+# number of decoded embedded images kept in memory per document
+DECODED_BINARIES_CACHE_SIZE = 8
+
+# number of (font file, size) pairs kept loaded for drawing text layers
+FONTS_CACHE_SIZE = 512
+
+# number of (font file, size, text) measurements kept for laying out text layers of a book
+TEXT_MEASURES_CACHE_SIZE = 50000
+
+# number of pages after and before current page rendered in background
+PREFETCH_NEXT_PAGES = 2
+PREFETCH_PREVIOUS_PAGES = 1
+
+# number of ACBF index files (.acbfidx) kept in CONFIG_DIR/Cache/Index
+INDEX_FILES_LIMIT = 1000
+
 exec_path = os.path.abspath(sys.argv[0])
 BASE_DIR = os.path.dirname(os.path.dirname(exec_path))
 
@@ -72,8 +72,12 @@ class FileChooserDialog(gtk.FileChooserDialog):
         self.run()
 
     def return_filename(self, widget, response):
-        if response == gtk.ResponseType.OK:
-          prepared_file = fileprepare.FilePrepare(self, self.get_filename(), self._window.tempdir, True)
+        # book open already keeps its archive and background extraction
+        if response == gtk.ResponseType.OK and self.get_filename() != self._window.original_filename:
+          self._window.stop_archive_loader()
+          prepared_file = fileprepare.FilePrepare(self, self.get_filename(), self._window.tempdir, True, lazy=True)
           self._window.filename = prepared_file.filename
+          self._window.archive = prepared_file.archive
+          self._window.archive_loader = prepared_file.loader
           self._window.original_filename = self.get_filename()
         self.destroy()
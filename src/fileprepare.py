@@ -24,33 +24,66 @@ import shutil
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk as gtk
-import zipfile
+from gi.repository import GLib
 import lxml.etree as xml
 from PIL import Image
 import subprocess
+import threading
+import time
+import concurrent.futures
 import patoolib
 
 try:
   from . import constants
   from . import preferences
+  from . import archive
+  from . import bookcache
+  from . import history
 except Exception:
   import constants
   import preferences
+  import archive
+  import bookcache
+  import history
 
 class FilePrepare():
     
-    def __init__(self, window, filename, tempdir, show_dialog):
+    def __init__(self, window, filename, tempdir, show_dialog, lazy=False, use_cache=True):
       self._window = window
       self.filename = filename
+      self.archive = None
+      self.loader = None
       file_type = None
       self.preferences = preferences.Preferences()
 
 
-      if zipfile.is_zipfile(filename):
-        file_type = 'ZIP'
-      elif filename[-4:].upper() == 'ACBF':
+      file_type = archive.get_archive_type(filename)
+      if file_type is None and filename[-4:].upper() == 'ACBF':
         return
 
+      # clear temp directory
+      for root, dirs, files in os.walk(tempdir):
+        for f in files:
+          os.unlink(os.path.join(root, f))
+        for d in dirs:
+          shutil.rmtree(os.path.join(root, d))
+
+      # reuse previously extracted/converted book from cache
+      # books imported into library are extracted into its temp directory only
+      book_cache = bookcache.BookCache(self.preferences, use_cache)
+      if book_cache.enabled:
+        book_dir, is_cached = book_cache.get_book_dir(filename)
+        acbf_filename = book_cache.get_acbf_filename(filename)
+        if is_cached and acbf_filename is not None and (lazy or book_cache.is_complete(filename)):
+          if file_type is not None and lazy:
+            self.archive = archive.open_archive(filename, book_dir, file_type)
+            if not book_cache.is_complete(filename):
+              self.start_loader(filename, book_dir, acbf_filename, book_cache)
+          self.filename = acbf_filename
+          return
+      else:
+        book_dir = tempdir
+
       # show progress bar
       progress_dialog = gtk.Dialog('Loading Comic Book ...', self._window, gtk.DialogFlags.MODAL | gtk.DialogFlags.DESTROY_WITH_PARENT, None)
       progress_dialog.set_resizable(False)
@@ -68,29 +101,44 @@ class FilePrepare():
       while gtk.events_pending():
         gtk.main_iteration()
 
-      # clear temp directory
-      for root, dirs, files in os.walk(tempdir):
-        for f in files:
-          os.unlink(os.path.join(root, f))
-        for d in dirs:
-          shutil.rmtree(os.path.join(root, d))
-
-      # extract files from CBZ into DATA_DIR
-      if file_type == 'ZIP':
-        z = zipfile.ZipFile(filename)
-        for idx, f in enumerate(z.namelist()):
-          fraction = float(idx)/len(z.namelist())
-          z.extract(f, tempdir)
-          progress_bar.set_fraction(fraction)
+      # extract files from archive into DATA_DIR
+      if file_type is not None:
+        try:
+          comic_archive = archive.open_archive(filename, book_dir, file_type)
+        except Exception as inst:
+          print("Failed to open archive, falling back to patool: %s" % inst)
+          file_type = None
+
+      if file_type is not None and lazy:
+        # keep archive open and extract only metadata, pages are read from archive when displayed
+        self.archive = comic_archive
+        members = [f for f in comic_archive.namelist() if is_metadata_file(f)]
+        for idx, f in enumerate(members):
+          progress_title.set_markup('Loading file %d of %d ...' % (idx + 1, len(members)))
+          comic_archive.extract(f, book_dir)
+          progress_bar.set_fraction(float(idx + 1)/len(members))
           while gtk.events_pending():
             gtk.main_iteration()
+      elif file_type is not None:
+        sizes = {}
+        for f in comic_archive.namelist():
+          sizes[f] = comic_archive.member_size(f)
+        solid = comic_archive.is_solid()
+        comic_archive.close()
+        try:
+          self.extract_members(filename, file_type, book_dir, sizes, solid, progress_bar, progress_title)
+        except Exception as inst:
+          self.show_message_dialog("Extract failed: %s" % inst)
+          self.filename = None
+          progress_dialog.destroy()
+          return
       else:
         print("running patool ...")
         progress_bar.set_fraction(0.5)
         while gtk.events_pending():
           gtk.main_iteration()
         try:
-          patoolib.extract_archive(filename, outdir=tempdir)
+          patoolib.extract_archive(filename, outdir=book_dir)
         except Exception as inst:
           self.show_message_dialog("Extract command failed: %s" % inst)
           self.filename = None
@@ -99,10 +147,10 @@ class FilePrepare():
 
       # check if there's ACBF file inside
       acbf_found = False
-      for datafile in os.listdir(tempdir):
+      for datafile in os.listdir(book_dir):
         if datafile[-4:] == 'acbf':
           acbf_found = True
-          return_filename = os.path.join(tempdir, datafile)
+          return_filename = os.path.join(book_dir, datafile)
 
       if not acbf_found:
         # create dummy acbf file
@@ -117,14 +165,17 @@ class FilePrepare():
         docinfo = xml.SubElement(metadata, "document-info")
         body = xml.SubElement(tree, "body")
 
-        if os.path.isfile(os.path.join(tempdir, "comic.xml")):
+        if os.path.isfile(os.path.join(book_dir, "comic.xml")):
           is_acv_file = True
         else:
           is_acv_file = False
 
-        for root, dirs, files in os.walk(tempdir):
-          for f in files:
-            all_files.append(os.path.join(root, f)[len(tempdir) + 1:])
+        if self.archive is not None:
+          all_files = self.archive.namelist()
+        else:
+          for root, dirs, files in os.walk(book_dir):
+            for f in files:
+              all_files.append(os.path.join(root, f)[len(book_dir) + 1:])
         for datafile in sorted(all_files):
           if datafile[-4:].upper() in ('.JPG', '.PNG', '.GIF', 'WEBP', '.BMP', 'JPEG'):
             if cover_image == '':
@@ -143,7 +194,7 @@ class FilePrepare():
 
         # check for ACV's comic.xml
         if is_acv_file:
-          acv_tree = xml.parse(source = os.path.join(tempdir, "comic.xml"))
+          acv_tree = xml.parse(source = os.path.join(book_dir, "comic.xml"))
 
           if acv_tree.getroot().get("bgcolor") != None:
             body.set("bgcolor", acv_tree.getroot().get("bgcolor"))
@@ -157,7 +208,7 @@ class FilePrepare():
           pattern_format = images.get("namePattern").replace("@index", "%%0%dd" % pattern_length)
           for screen in acv_tree.findall("screen"):
             element = files_to_elements[pattern_format % int(screen.get("index"))]
-            xsize, ysize = Image.open(os.path.join(tempdir, element.get('href'))).size
+            xsize, ysize = self.open_image(book_dir, element.get('href')).size
             for frame in screen:
               x1, y1, w, h = list(map(float, frame.get("relativeArea").split(" ")))
               ix1 = int(xsize * x1)
@@ -170,9 +221,9 @@ class FilePrepare():
                 frame_elt.set("bgcolor", frame.get("bgcolor"))
 
         # check if there's ComicInfo.xml file inside
-        elif os.path.isfile(os.path.join(tempdir, "ComicInfo.xml")):
+        elif os.path.isfile(os.path.join(book_dir, "ComicInfo.xml")):
           # load comic book information from ComicInfo.xml
-          comicinfo_tree = xml.parse(source = os.path.join(tempdir, "ComicInfo.xml"))
+          comicinfo_tree = xml.parse(source = os.path.join(book_dir, "ComicInfo.xml"))
 
           for author in ["Writer", "Penciller", "Inker", "Colorist", "CoverArtist", "Adapter", "Letterer"]:
             if comicinfo_tree.find(author) != None:
@@ -232,16 +283,166 @@ class FilePrepare():
 
         # save generated acbf file
         progress_bar.set_fraction(1)
-        return_filename = os.path.join(tempdir, os.path.splitext(os.path.basename(filename))[0] + '.acbf')
+        return_filename = os.path.join(book_dir, os.path.splitext(os.path.basename(filename))[0] + '.acbf')
         f = open(return_filename, 'w')
         f.write(xml.tostring(tree, pretty_print=True, encoding="unicode"))
         f.close()
 
+      if book_cache.enabled:
+        book_cache.store_book(filename, return_filename, self.archive is None)
+
+      # without cache pages are read from archive when displayed, nothing is extracted in background
+      if self.archive is not None and book_cache.enabled:
+        self.start_loader(filename, book_dir, return_filename, book_cache)
+
       self.filename = return_filename
       progress_dialog.destroy()
 
+    def extract_members(self, filename, file_type, book_dir, sizes, solid, progress_bar, progress_title):
+      """Extracts archive members in thread pool (one archive handle per worker thread),
+      solid archives in one pass. Progress is updated from GTK thread several times a second."""
+      handles = threading.local()
+      opened = []
+      opened_lock = threading.Lock()
+      extracted = []
+
+      def extract(names):
+        if not hasattr(handles, 'archive'):
+          handles.archive = archive.open_archive(filename, book_dir, file_type)
+          with opened_lock:
+            opened.append(handles.archive)
+        for name in handles.archive.extract_all(names, book_dir):
+          extracted.append(name)
+
+      if solid:
+        # reading members one by one would decompress solid block from its start for each of them
+        workers = 1
+        jobs = [list(sizes)]
+      else:
+        workers = min(8, os.cpu_count() or 1)
+        jobs = [[name] for name in sizes]
+      total_bytes = max(1, sum(sizes.values()))
+      done_bytes = done_count = 0
+      start_time = time.time()
+      executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+      pending = set()
+      for names in jobs:
+        pending.add(executor.submit(extract, names))
+      try:
+        while pending:
+          done, pending = concurrent.futures.wait(pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+          for future in done:
+            future.result()
+          for name in extracted[done_count:]:
+            done_bytes = done_bytes + sizes[name]
+          done_count = len(extracted)
+          elapsed = max(0.001, time.time() - start_time)
+          speed = done_bytes / elapsed
+          if speed > 0:
+            eta = ' %d s left' % ((total_bytes - done_bytes) / speed)
+          else:
+            eta = ''
+          progress_title.set_markup('Loading file %d of %d (%.1f MB/s%s) ...' % (done_count, len(sizes), speed / 1048576, eta))
+          progress_bar.set_fraction(float(done_bytes) / total_bytes)
+          while gtk.events_pending():
+            gtk.main_iteration()
+      finally:
+        for future in pending:
+          future.cancel()
+        executor.shutdown(wait=True)
+        for comic_archive in opened:
+          comic_archive.close()
+
+    def start_loader(self, filename, book_dir, acbf_filename, book_cache):
+      """Extracts cover and last read page right away, the rest of the archive in background."""
+      members = self.get_reading_order(filename, acbf_filename)
+      for name in members[:2]:
+        if not os.path.isfile(os.path.join(book_dir, name)):
+          self.archive.extract(name, book_dir)
+      self.loader = ArchiveLoader(filename, book_dir, acbf_filename, members[2:], book_cache)
+      self.loader.start()
+
+    def get_reading_order(self, filename, acbf_filename):
+      """Returns archive members ordered by cover, last read page, pages following it, pages before it, other files."""
+      hrefs = []
+      try:
+        root = xml.parse(source = acbf_filename).getroot()
+        for image in root.iterfind("{*}meta-data/{*}book-info/{*}coverpage/{*}image"):
+          hrefs.append(image.get("href"))
+        for image in root.iterfind("{*}body/{*}page/{*}image"):
+          hrefs.append(image.get("href"))
+      except Exception as inst:
+        print("Failed to read page order: %s" % inst)
+
+      names = []
+      for href in hrefs:
+        names.append(self.archive.member_name(os.path.join(os.path.dirname(acbf_filename), href or '')))
+
+      current_page = history.History().get_book_details(filename)[0]
+      if current_page < 1 or current_page > len(names):
+        current_page = 1
+
+      members = []
+      added = set()
+      for name in names[:1] + names[current_page - 1:] + names[1:current_page - 1] + sorted(self.archive.namelist()):
+        if name is not None and name not in added:
+          members.append(name)
+          added.add(name)
+      return members
+
+    def open_image(self, book_dir, path):
+      """Opens image from open archive, or extracted one from book directory."""
+      if self.archive is not None:
+        return Image.open(self.archive.open(path))
+      return Image.open(os.path.join(book_dir, path))
+
     def show_message_dialog(self, text):
         message = gtk.MessageDialog(parent=None, flags=0, type=gtk.MessageType.INFO, buttons=gtk.ButtonsType.OK, message_format=None)
         message.set_markup(text)
         response = message.run()
         message.destroy()
+
+class ArchiveLoader(threading.Thread):
+
+    """Extracts remaining archive members into book directory in background thread.
+    Pages not extracted yet are read from the archive meanwhile.
+    Book is marked complete in book cache from GTK thread once all members are extracted."""
+
+    def __init__(self, filename, book_dir, acbf_filename, members, book_cache):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.filename = filename
+      self.book_dir = book_dir
+      self.acbf_filename = acbf_filename
+      self.members = members
+      self.book_cache = book_cache
+      self.stop_event = threading.Event()
+
+    def run(self):
+      # own archive handle, archive readers can't be shared between threads
+      comic_archive = archive.open_archive(self.filename, self.book_dir)
+      try:
+        names = [name for name in self.members if not os.path.isfile(os.path.join(self.book_dir, name))]
+        # solid archives are extracted in one pass, stop takes effect once it is done
+        for name in comic_archive.extract_all(names, self.book_dir):
+          if self.stop_event.is_set():
+            return
+      except Exception as inst:
+        print("Background extraction failed: %s" % inst)
+        return
+      finally:
+        comic_archive.close()
+
+      GLib.idle_add(self.book_cache.store_book, self.filename, self.acbf_filename, True)
+
+    def stop(self):
+      self.stop_event.set()
+      self.join()
+
+def is_metadata_file(name):
+    """Returns True for archive members needed before the first page is shown (ACBF/ACV/ComicInfo files and fonts)."""
+    if name.startswith('Fonts/'):
+      return True
+    if '/' in name:
+      return False
+    return name[-4:] == 'acbf' or name in ('comic.xml', 'ComicInfo.xml')
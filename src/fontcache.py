@@ -0,0 +1,93 @@
+"""fontcache.py - persistent cache of font lookups used by stylesheets.
+
+Copyright (C) 2011-2025 Robert Kubik
+https://github.com/ACBF-Advanced-Comic-Book-Format
+"""
+
+# -------------------------------------------------------------------------
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# -------------------------------------------------------------------------
+
+
+import os
+import hashlib
+import lxml.etree as xml
+
+try:
+  from . import constants
+except Exception:
+  import constants
+
+class FontCache():
+
+  """Keeps (family, style, weight, stretch) -> font file lookups in CONFIG_DIR/fonts.xml,
+     so matplotlib font manager is only loaded for fonts not looked up before.
+     Cache is dropped when any of the system font directories changes."""
+
+  def __init__(self):
+      self.cache_file_path = os.path.join(constants.CONFIG_DIR, 'fonts.xml')
+      self.fonts = {}
+      self.is_changed = False
+      self.signature = get_fonts_signature()
+      self.load_cache()
+
+  def load_cache(self):
+      try:
+        tree = xml.parse(source = self.cache_file_path).getroot()
+      except:
+        return
+      if tree.findtext("version") != constants.VERSION or tree.findtext("signature") != self.signature:
+        self.is_changed = True
+        return
+      for font in tree.findall("font"):
+        self.fonts[(font.get("family"), font.get("style"), font.get("weight"), font.get("stretch"))] = font.get("path")
+
+  def save_cache(self):
+      if not self.is_changed:
+        return
+      tree = xml.Element("fonts")
+      version = xml.SubElement(tree, "version")
+      version.text = constants.VERSION
+      signature = xml.SubElement(tree, "signature")
+      signature.text = self.signature
+      for key, path in self.fonts.items():
+        xml.SubElement(tree, "font", family=key[0], style=key[1], weight=key[2], stretch=key[3], path=path)
+      f = open(self.cache_file_path, 'w')
+      f.write(xml.tostring(tree, encoding='unicode', pretty_print=True))
+      f.close()
+      self.is_changed = False
+
+  def find_font(self, family, style, weight, stretch):
+      """Returns path to system font file ('' if font was not found)."""
+      key = (family, style, weight, stretch)
+      if key not in self.fonts:
+        from matplotlib import font_manager
+        try:
+          prop = font_manager.FontProperties(family=family, style=style, weight=weight, stretch=stretch)
+          font = str(font_manager.findfont(prop, fontext='ttf', fallback_to_default=False))
+        except Exception:
+          font = ''
+        self.fonts[key] = font
+        self.is_changed = True
+      return self.fonts[key]
+
+def get_fonts_signature():
+    """Hash of font directories and their modification times (changes when fonts are added or removed)."""
+    signature = hashlib.sha1()
+    for font_dir in constants.FONTS_DIR:
+      for root, dirs, files in os.walk(font_dir):
+        try:
+          signature.update(('%s|%d\n' % (root, os.stat(root).st_mtime_ns)).encode('utf-8', 'replace'))
+        except OSError:
+          None
+    return signature.hexdigest()
@@ -24,15 +24,14 @@ import os
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk as gtk
-from gi.repository import Gdk
-from gi.repository import GdkPixbuf
-import io
 from PIL import Image, ImageDraw, ImageFont
 
 try:
   from . import constants
+  from . import comicpage
 except Exception:
   import constants
+  import comicpage
 
 class FontSelectionDialog(gtk.Dialog):
     
@@ -121,26 +120,6 @@ class FontSelectionDialog(gtk.Dialog):
         draw.text((10, 10), "AaBbCc DdEeFf", font=font, fill="#000")
 
 
-        pixbuf_image = pil_to_pixbuf(font_image, "#000")
+        pixbuf_image = comicpage.pil_to_pixbuf(font_image, "#000")
         self.font_image.set_from_pixbuf(pixbuf_image)
         
-
-
-def pil_to_pixbuf(PILImage, BGColor):
-    """Return a pixbuf created from the PIL <image>."""
-
-    bcolor = (int(Gdk.color_parse(BGColor).red_float*255), int(Gdk.color_parse(BGColor).green_float*255), int(Gdk.color_parse(BGColor).blue_float*255))
-
-    PILImage = PILImage.convert("RGBA")
-    bg = Image.new("RGB", PILImage.size, bcolor)
-    bg.paste(PILImage,PILImage)
-
-    with io.BytesIO() as dummy_file:
-      bg.save(dummy_file, "ppm")
-      contents = dummy_file.getvalue()
-
-    loader = GdkPixbuf.PixbufLoader()
-    loader.write(contents)
-    pixbuf = loader.get_pixbuf()
-    loader.close()
-    return pixbuf
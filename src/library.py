@@ -1643,7 +1643,7 @@ class LibraryDialog(gtk.Dialog):
         return True
 
     def load_file(self, in_filename, show_dialog):
-        prepared_file = fileprepare.FilePrepare(self, in_filename, self._window.library_dir, show_dialog)
+        prepared_file = fileprepare.FilePrepare(self, in_filename, self._window.library_dir, show_dialog, use_cache=False)
         filename = prepared_file.filename
         self.tempdir = self._window.library_dir
         acbf_document = acbfdocument.ACBFDocument(self, filename)
@@ -1652,7 +1652,9 @@ class LibraryDialog(gtk.Dialog):
           return None, None, None, None, None, None, None, None, None, None, None, None, None
 
         # coverpage
-        coverpage = acbf_document.coverpage
+        coverpage = acbf_document.load_cover_image((150, 150))
+        if coverpage is None:
+          return None, None, None, None, None, None, None, None, None, None, None, None, None
         coverpage.thumbnail((int(coverpage.size[0]*150/float(coverpage.size[1])),150), Image.Resampling.NEAREST)
         output_directory = os.path.join(os.path.join(constants.CONFIG_DIR, 'Covers'), acbf_document.book_title[list(acbf_document.book_title.items())[0][0]][0].upper())
         if not os.path.exists(output_directory):
@@ -1698,7 +1700,7 @@ class LibraryDialog(gtk.Dialog):
         # image formats
         image_formats = []
         for page in acbf_document.pages:
-          im_format = page.find("image").get("href")[-4:].upper().strip('.')
+          im_format = page.image_href[-4:].upper().strip('.')
           if im_format not in image_formats:
             image_formats.append(im_format)
         im_formats_str = str(image_formats)[1:][:-1].replace("u'", "").replace("'", "")
@@ -1908,26 +1910,6 @@ class Library():
       return
 
 
-def pil_to_pixbuf(PILImage, BGColor):
-    """Return a pixbuf created from the PIL <image>."""
-
-    bcolor = (int(gtk.gdk.color_parse(BGColor).red_float*255), int(gtk.gdk.color_parse(BGColor).green_float*255), int(gtk.gdk.color_parse(BGColor).blue_float*255))
-
-    PILImage = PILImage.convert("RGBA")
-    bg = Image.new("RGB", PILImage.size, bcolor)
-    bg.paste(PILImage,PILImage)
-
-    dummy_file = io.StringIO()
-    bg.save(dummy_file, "ppm")
-    contents = dummy_file.getvalue()
-    dummy_file.close()
-
-    loader = gtk.gdk.PixbufLoader("pnm")
-    loader.write(contents, len(contents))
-    pixbuf = loader.get_pixbuf()
-    loader.close()
-    return pixbuf
-
 # function to retrieve text value from element without throwing exception
 def get_element_text2(element_tree, element):
     try:
@@ -113,12 +113,19 @@ class MainWindow(gtk.Window):
           os.makedirs(os.path.join(constants.CONFIG_DIR, 'Covers'), 0o700)
 
         self.filename = open_path
+        self.archive = None
+        self.archive_loader = None
         if open_path != None:
-          prepared_file = fileprepare.FilePrepare(self, open_path, self.tempdir, True)
+          prepared_file = fileprepare.FilePrepare(self, open_path, self.tempdir, True, lazy=True)
           self.filename = prepared_file.filename
+          self.archive = prepared_file.archive
+          self.archive_loader = prepared_file.loader
         self.original_filename = open_path
         
-        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename)
+        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename, self.archive)
+        self.render_cache = comicpage.RenderCache(self.preferences)
+        self.text_measures = comicpage.TextMeasureCache()
+        self.prefetcher = comicpage.Prefetcher(self)
 
         # get last reading position
         (self.page_number, self.frame_number, self.zoom_level, self.language_layer) = self.history.get_book_details(self.original_filename)
@@ -230,7 +237,8 @@ class MainWindow(gtk.Window):
       filename_before = self.filename
       self.filechooser = filechooser.FileChooserDialog(self)
       if filename_before != self.filename and self.filename != None:
-        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename)
+        self.close_archive()
+        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename, self.archive)
         self.toolbar.update()
         (self.page_number, self.frame_number, self.zoom_level, self.language_layer) = self.history.get_book_details(self.original_filename)
         if self.page_number > self.acbf_document.pages_total:
@@ -292,6 +300,8 @@ class MainWindow(gtk.Window):
       if self.prefs_dialog.isChanged:
         self.preferences.save_preferences()
         self.prefs_dialog.destroy()
+        self.prefetcher.cancel()
+        self.render_cache.clear()
         if self.acbf_document.valid:
           self.display_page(True, None)
       else:
@@ -487,16 +497,24 @@ class MainWindow(gtk.Window):
       self.history.set_book_details(self.original_filename, self.page_number, self.frame_number, self.zoom_level, self.toolbar.language.get_active())
       self.history.save_history()
       filename_before = self.filename
+      original_filename_before = self.original_filename
       self.library_dialog = library.LibraryDialog(self)
       self.loading_page_icon.show()
       while gtk.events_pending():
         gtk.main_iteration()
 
-      if self.filename != None:
-        prepared_file = fileprepare.FilePrepare(self, self.filename, self.tempdir, True)
+      if self.filename != None and self.original_filename == original_filename_before:
+        # book open already keeps its archive and background extraction
+        self.filename = filename_before
+      elif self.filename != None and filename_before != self.filename:
+        self.stop_archive_loader()
+        prepared_file = fileprepare.FilePrepare(self, self.filename, self.tempdir, True, lazy=True)
         self.filename = prepared_file.filename
+        self.archive = prepared_file.archive
+        self.archive_loader = prepared_file.loader
       if filename_before != self.filename:
-        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename)
+        self.close_archive()
+        self.acbf_document = acbfdocument.ACBFDocument(self, self.filename, self.archive)
         self.toolbar.update()
         (self.page_number, self.frame_number, self.zoom_level, self.language_layer) = self.history.get_book_details(self.original_filename)
         if self.page_number > self.acbf_document.pages_total:
@@ -984,7 +1002,7 @@ class MainWindow(gtk.Window):
       window_height = self.drawable_size[1]
       #print ('Window size: ', window_width, window_height)
 
-      frame_span = get_frame_span(self.acbf_document.load_page_frames(self.page_number)[frame_number - 1][0])
+      frame_span = self.acbf_document.get_page(self.page_number).frame_spans[frame_number - 1]
       frame_width = frame_span[2] - frame_span[0]
       frame_height = frame_span[3] - frame_span[1]
       #print ('Frame size: ', frame_width, frame_height)
@@ -1073,9 +1091,7 @@ class MainWindow(gtk.Window):
         self.scrolled.get_vadjustment().set_value(self.current_y)
 
         if animation_frame%2 == 0: # every even step gets image loaded
-          while t.is_alive():
-            #print ('thread')
-            sleep(0.01)
+          t.join()
           self.comic_page_box.set_from_pixbuf(self.new_image)
 
         slp = float(self.preferences.get_value("animation_delay"))/500
@@ -1139,6 +1155,7 @@ class MainWindow(gtk.Window):
       if self.zoom_index > 3:
         self.zoom_index = 0
       self.zoom_level = self.zoom_list[self.zoom_index]
+      self.comic_page.ensure_resolution()
       if self.zoom_level == 2:
         if self.comic_page.rotation == 180:
           image_height = int(float(self.comic_page.PILBackgroundImageProcessed.size[1])/(float(self.comic_page.PILBackgroundImageProcessed.size[0])/float(self.drawable_size[0])))
@@ -1192,7 +1209,7 @@ class MainWindow(gtk.Window):
         else:
           if self.page_number > 1:
             self.page_number = self.page_number - 1
-            self.frame_number = len(self.acbf_document.load_page_frames(self.page_number))
+            self.frame_number = len(self.acbf_document.get_page(self.page_number).frames)
             self.display_page(True, None)
             self.zoom_to_frame(self.frame_number, move=True)
       else:
@@ -1228,7 +1245,7 @@ class MainWindow(gtk.Window):
       update = False
       if self.zoom_level == 3:
         self.page_number = self.acbf_document.pages_total + 1
-        self.frame_number = len(self.acbf_document.load_page_frames(self.page_number))
+        self.frame_number = len(self.acbf_document.get_page(self.page_number).frames)
         update = True
       elif self.zoom_level == 2:
         self.page_number = self.acbf_document.pages_total + 1
@@ -1268,7 +1285,15 @@ class MainWindow(gtk.Window):
         self.toolbar.entry.set_text(str(self.page_number))
 
     def change_language(self, *args):
-      self.display_page(True, None)
+      if self.comic_page.is_loaded():
+        # page image stays, text layer of the language is composited over it
+        self.comic_page.load_texts()
+        self.comic_page.ensure_resolution()
+        self.comic_page.updated = False
+        self.display_page(False, None)
+        self.pixbuf = self.original_pixbuf
+      else:
+        self.display_page(True, None)
       self.language_layer = self.toolbar.language.get_active()
       if len(self.acbf_document.contents_table[self.toolbar.language.get_active()]) == 0:
         self.toolbar.index_button.set_sensitive(False)
@@ -1295,6 +1320,7 @@ class MainWindow(gtk.Window):
           self.drawable_size = (self.layout.get_allocation().width, self.layout.get_allocation().height)
 
         self.comic_page.updated = False
+        self.comic_page.ensure_resolution()
         self.display_page(False, None)
         if self.zoom_level == 3:
           self.zoom_to_frame(self.frame_number, move=True)
@@ -1421,8 +1447,8 @@ class MainWindow(gtk.Window):
        if self.comic_page.references != [] and self.zoom_level != 3:
          x_resize = int(event.x) - self.comic_page_box.get_allocation().x
          y_resize = int(event.y) - self.comic_page_box.get_allocation().y
-         x_ratio = float(float(self.comic_page.PILBackgroundImage.size[0])/self.comic_page_box.get_allocation().width)
-         y_ratio = float(float(self.comic_page.PILBackgroundImage.size[1])/self.comic_page_box.get_allocation().height)
+         x_ratio = float(float(self.comic_page.image_size[0])/self.comic_page_box.get_allocation().width)
+         y_ratio = float(float(self.comic_page.image_size[1])/self.comic_page_box.get_allocation().height)
          x_original = x_resize * x_ratio
          y_original = y_resize * y_ratio
 
@@ -1522,8 +1548,7 @@ class MainWindow(gtk.Window):
           sleep(slp)
 
       if update:
-        while t.is_alive():
-          sleep(0.01)
+        t.join()
 
       if self.zoom_level != 2 or not self.comic_page.updated:
         # load new image
@@ -1664,12 +1689,35 @@ class MainWindow(gtk.Window):
 
       self.loading_page_icon.hide()
       self.is_rendering = False
+      self.prefetcher.schedule()
 
       return True
 
+    def close_archive(self, *args):
+      # close archives kept open by previous document (lazy archive mode, zip: image references)
+      if self.acbf_document.archive is not None and self.acbf_document.archive != self.archive:
+        self.acbf_document.archive.close()
+      self.prefetcher.cancel()
+      self.acbf_document.close_zip_archives()
+      self.render_cache.clear()
+      self.text_measures.clear()
+      return
+
+    def stop_archive_loader(self, *args):
+      # stop background extraction of previous book
+      if self.archive_loader is not None:
+        self.archive_loader.stop()
+        self.archive_loader = None
+      return
+
     def terminate_program(self, *args):
       self.history.set_book_details(self.original_filename, self.page_number, self.frame_number, self.zoom_level, self.toolbar.language.get_active())
       self.history.save_history()
+      self.prefetcher.shutdown()
+      self.stop_archive_loader()
+      if self.acbf_document.archive is not None:
+        self.acbf_document.archive.close()
+      self.acbf_document.close_zip_archives()
 
       # clear temp directory
       for root, dirs, files in os.walk(self.tempdir):
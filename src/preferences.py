@@ -96,7 +96,8 @@ class Preferences():
                       "popup_text_showing", "progress_bar_showing", "progress_bar_width", "progress_bar_color", "normal_font", "emphasis_font",
                       "strong_font", "code_font", "commentary_font", "font_color_default", "font_color_inverted", "library_books_per_page",
                       "library_cleanup", "library_layout", "library_default_sort_order", "library_custom_filters", "default_language",
-                      "autorotate", "tmpfs", "tmpfs_dir", "crop_border", "animation", "animation_delay", "comics_dir"]:
+                      "autorotate", "tmpfs", "tmpfs_dir", "crop_border", "animation", "animation_delay", "comics_dir",
+                      "cache_size", "cache_content_hash", "render_cache_size"]:
         if self.tree.find(element) == None:
           self.set_default_value(element)
 
@@ -195,4 +196,22 @@ class Preferences():
       elif element == 'comics_dir':
         comics_dir = xml.SubElement(self.tree, "comics_dir")
         comics_dir.text = "."
+      elif element == 'cache_size':
+        """ Size limit (in MB) of the cache of extracted and converted comic books (~/.config/acbfv/Cache).
+            Least recently opened books are removed when the limit is exceeded. Set to 0 to disable the cache.
+        """
+        cache_size = xml.SubElement(self.tree, "cache_size")
+        cache_size.text = "1024"
+      elif element == 'cache_content_hash':
+        """ Also compare a quick hash of the beginning and end of the file when looking up a book in cache
+            (not only its path, size and modification time).
+        """
+        cache_content_hash = xml.SubElement(self.tree, "cache_content_hash")
+        cache_content_hash.text = "False"
+      elif element == 'render_cache_size':
+        """ Memory budget (in MB) for rendered pages kept in memory, so going back to recently shown pages
+            or zoom levels doesn't render them again. Set to 0 to disable.
+        """
+        render_cache_size = xml.SubElement(self.tree, "render_cache_size")
+        render_cache_size.text = "256"
 
@@ -118,6 +118,44 @@ class PrefsDialog(gtk.Dialog):
           self.tmpfs_entry.set_sensitive(False)
 
         tab.pack_start(hbox, False, False, 0)
+
+        # book cache
+        hbox = gtk.HBox(False, 0)
+        hbox.set_border_width(5)
+
+        label = gtk.Label()
+        label.set_markup('Book cache size (MB): ')
+        label.set_tooltip_text("Extracted comic books are kept between sessions so they open faster next time. Set to 0 to disable.")
+        hbox.pack_start(label, False, False, 0)
+
+        adj = gtk.Adjustment(1024, 0, 102400, 128.0, 1024.0, 0.0)
+        cache_size = gtk.SpinButton(adjustment=adj, climb_rate=0, digits=0)
+        cache_size.set_numeric(True)
+        cache_size.set_value(int(self._window.preferences.get_value("cache_size")))
+        cache_size.show()
+        hbox.pack_start(cache_size, False, False, 0)
+        cache_size.connect('value_changed', self.set_cache_size)
+
+        tab.pack_start(hbox, False, False, 0)
+
+        # rendered pages cache
+        hbox = gtk.HBox(False, 0)
+        hbox.set_border_width(5)
+
+        label = gtk.Label()
+        label.set_markup('Rendered pages memory (MB): ')
+        label.set_tooltip_text("Recently shown pages are kept rendered in memory, so going back to them is instant. Set to 0 to disable.")
+        hbox.pack_start(label, False, False, 0)
+
+        adj = gtk.Adjustment(256, 0, 16384, 32.0, 256.0, 0.0)
+        render_cache_size = gtk.SpinButton(adjustment=adj, climb_rate=0, digits=0)
+        render_cache_size.set_numeric(True)
+        render_cache_size.set_value(int(self._window.preferences.get_value("render_cache_size")))
+        render_cache_size.show()
+        hbox.pack_start(render_cache_size, False, False, 0)
+        render_cache_size.connect('value_changed', self.set_render_cache_size)
+
+        tab.pack_start(hbox, False, False, 0)
         
         notebook.insert_page(scrolled, gtk.Label('General'), -1)
 
@@ -628,6 +666,17 @@ class PrefsDialog(gtk.Dialog):
         self.isChanged = True
         return True
 
+    def set_cache_size(self, widget):
+        self._window.preferences.set_value("cache_size", str(widget.get_value_as_int()))
+        self.isChanged = True
+        return True
+
+    def set_render_cache_size(self, widget):
+        self._window.preferences.set_value("render_cache_size", str(widget.get_value_as_int()))
+        self._window.render_cache.set_size_limit(widget.get_value_as_int())
+        self.isChanged = True
+        return True
+
     def set_animation_delay(self, widget):
         self._window.preferences.set_value("animation_delay", str(widget.get_value_as_int()))
         self.isChanged = True
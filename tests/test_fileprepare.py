@@ -0,0 +1,115 @@
+"""test_fileprepare.py - opening ACV and corrupt archives with FilePrepare."""
+
+import os
+import sys
+import io
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+  import gi
+  import patoolib
+except ImportError:
+  gi = None
+
+if gi is not None:
+  import lxml.etree as xml
+  from PIL import Image
+  import constants
+  import fileprepare
+
+ACV_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<comic title="ACV Test" bgcolor="#FFFFFF">
+  <images indexPattern="000" namePattern="@index"/>
+  <screen index="1">
+    <frame relativeArea="0 0 0.5 0.5"/>
+    <frame relativeArea="0.5 0.5 0.5 0.5" bgcolor="#000000"/>
+  </screen>
+</comic>'''
+
+def image_bytes(size):
+    data = io.BytesIO()
+    Image.new('RGB', size, (255, 255, 255)).save(data, 'JPEG')
+    return data.getvalue()
+
+@unittest.skipIf(gi is None, "GTK or patool is not available")
+class FilePrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.tempdir = os.path.join(self.work_dir, 'temp')
+        os.makedirs(self.tempdir)
+        config_dir = os.path.join(self.work_dir, 'config')
+        os.makedirs(config_dir)
+        patcher = mock.patch.object(constants, 'CONFIG_DIR', config_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.messages = []
+        patcher = mock.patch.object(fileprepare.FilePrepare, 'show_message_dialog', lambda prepared, text: self.messages.append(text))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def make_acv(self):
+        filename = os.path.join(self.work_dir, 'test.acv')
+        with zipfile.ZipFile(filename, 'w') as z:
+          z.writestr('comic.xml', ACV_XML)
+          z.writestr('000.jpg', image_bytes((100, 100)))
+          z.writestr('001.jpg', image_bytes((200, 100)))
+          z.writestr('002.jpg', image_bytes((200, 100)))
+        return filename
+
+    def check_acv(self, prepared):
+        self.assertEqual(self.messages, [])
+        tree = xml.parse(source = prepared.filename).getroot()
+        frames = tree.findall("{*}body/{*}page/{*}frame")
+        self.assertEqual([frame.get("points") for frame in frames], ["0,0 100,0 100,50 0,50", "100,50 200,50 200,100 100,100"])
+        self.assertEqual(frames[1].get("bgcolor"), "#000000")
+        self.assertEqual(tree.find("{*}body").get("bgcolor"), "#FFFFFF")
+
+    def test_open_acv(self):
+        prepared = fileprepare.FilePrepare(None, self.make_acv(), self.tempdir, False)
+        self.check_acv(prepared)
+
+    def test_open_acv_lazy(self):
+        prepared = fileprepare.FilePrepare(None, self.make_acv(), self.tempdir, False, lazy=True)
+        self.assertIsNotNone(prepared.archive)
+        self.check_acv(prepared)
+        prepared.loader.stop()
+        prepared.archive.close()
+
+    def test_open_without_cache(self):
+        prepared = fileprepare.FilePrepare(None, self.make_acv(), self.tempdir, False, use_cache=False)
+        self.check_acv(prepared)
+        self.assertEqual(os.path.dirname(prepared.filename), self.tempdir)
+        self.assertFalse(os.path.exists(os.path.join(constants.CONFIG_DIR, 'Cache')))
+
+    def test_open_lazy_without_cache(self):
+        prepared = fileprepare.FilePrepare(None, self.make_acv(), self.tempdir, False, lazy=True, use_cache=False)
+        self.check_acv(prepared)
+        self.assertIsNone(prepared.loader)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, '001.jpg')))
+        prepared.archive.close()
+
+    def test_open_corrupt_archive(self):
+        filename = os.path.join(self.work_dir, 'corrupt.cbz')
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+          z.writestr('001.jpg', os.urandom(4096))
+        with open(filename, 'r+b') as f:
+          # damage compressed data of the member, central directory stays readable
+          f.seek(100)
+          f.write(b'\0' * 1000)
+        prepared = fileprepare.FilePrepare(None, filename, self.tempdir, False)
+        self.assertIsNone(prepared.filename)
+        self.assertEqual(len(self.messages), 1)
+        self.assertTrue(self.messages[0].startswith("Extract failed"))
+
+if __name__ == '__main__':
+    unittest.main()